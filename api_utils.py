@@ -1,4 +1,10 @@
+import array
+import asyncio
+import base64
+import bisect
 import collections 
+import concurrent.futures
+import contextlib
 import platform
 if platform.system() == "Windows":
     crypt = None
@@ -7,12 +13,24 @@ else:
 import datetime
 import functools
 import inspect
+import heapq
+import io
 import itertools
 import json
+import mmap
+import operator
+import os
 import queue
+import re
+import select
+import signal
+import socket
+import socketserver
 import sys
 import threading
+import time
 import traceback
+import zlib
 
 try:
     import werkzeug
@@ -21,10 +39,15 @@ except ImportError:
     system("pip install werkzeug")
     import werkzeug
 
+import werkzeug.datastructures
+import werkzeug.http
 import werkzeug.routing
+import werkzeug.serving
+import werkzeug.wsgi
 from werkzeug.exceptions import (
     HTTPException,
     NotFound,
+    ServiceUnavailable,
     Unauthorized,
     UnprocessableEntity,
     UnsupportedMediaType,
@@ -38,6 +61,17 @@ except ImportError:
     # Do not complain now, but only when auth classes get instantiated
     jwt = None
 
+# Optional faster JSON libraries, see `json_codec`
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 
 class API:
     """JSON API.
@@ -107,12 +141,33 @@ class API:
     >>> body, code, *_ = client.put("/", data=data)
     >>> code
     '415 UNSUPPORTED MEDIA TYPE'
+
+    For production, responses can be sent as compact JSON without indentation:
+    >>> compact_app = API(compact=True)
+    >>> @compact_app.GET("/")
+    ... def numbers(request):
+    ...     return {"numbers": [1, 2, 3]}
+    ...
+    >>> body, code, *_ = Client(compact_app).get("/")
+    >>> b"".join(body)
+    b'{"numbers":[1,2,3]}\\n'
+
+    Binary data in responses is sent base64 encoded:
+    >>> @app.GET("/binary")
+    ... def binary(request):
+    ...     return {"content": b"Hello"}
+    ...
+    >>> body, code, *_ = client.get("/binary")
+    >>> json.loads(b"".join(body))
+    {'content': 'SGVsbG8='}
     """
 
-    def __init__(self):
+    def __init__(self, compact=False):
         self._url_map = werkzeug.routing.Map()
+        self._etags = {}
+        self.compact = compact
 
-    def route(self, string, methods=("GET",), func=None):
+    def route(self, string, methods=("GET",), func=None, etag=None):
         """Register a route with a callback.
 
         This function can be used either directly:
@@ -138,9 +193,33 @@ class API:
         (<werkzeug.wsgi.ClosingIterator ...>, '200 OK', Headers(...))
         >>> json.loads(b"".join(_[0]))
         'Welcome home 007!'
+
+        Responses can be made conditional with an `etag` function. It is
+        called with the same arguments as the handler and returns a strong
+        entity tag (or None), usually derived from a version counter. When
+        the client already has the current version (If-None-Match), a
+        304 Not Modified response is sent without calling the handler:
+        >>> version = 1
+        >>> @api.route("/counter", etag=lambda request: str(version))
+        ... def counter(request):
+        ...     print("computing")
+        ...     return version
+        ...
+        >>> body, code, headers = client.get("/counter")
+        computing
+        >>> headers["ETag"]
+        '"1"'
+        >>> body, code, headers = client.get("/counter", headers={"If-None-Match": '"1"'})
+        >>> code
+        '304 NOT MODIFIED'
+        >>> version = 2
+        >>> body, code, headers = client.get("/counter", headers={"If-None-Match": '"1"'})
+        computing
+        >>> code, headers["ETag"]
+        ('200 OK', '"2"')
         """
         if func is None:
-            return functools.partial(self.route, string, methods)
+            return functools.partial(self.route, string, methods, etag=etag)
 
         rule = werkzeug.routing.Rule(string, methods=methods)
         werkzeug.routing.Map([rule])  # Bind rule temporarily
@@ -169,6 +248,7 @@ class API:
                 else dict
             )
             content_types = {}
+            fields = None
         elif body_params:
             body_type = dict
             content_types = {
@@ -176,14 +256,18 @@ class API:
                 for key in body_params
                 if params[key].annotation is not inspect.Parameter.empty
             }
+            fields = body_params
 
         if body_type:
-            func = _parse_json_body(func, body_type, content_types)
+            func = _parse_json_body(func, body_type, content_types, fields)
+
+        if etag is not None:
+            self._etags[func] = etag
 
         self._url_map.add(werkzeug.routing.Rule(string, methods=methods, endpoint=func))
         return func
 
-    def GET(self, string):
+    def GET(self, string, etag=None):
         """Shorthand for registering GET requests.
 
         Use as a decorator:
@@ -196,8 +280,10 @@ class API:
         >>> client = Client(api)
         >>> client.get("/admin")   # doctest: +ELLIPSIS
         (<werkzeug.wsgi.ClosingIterator ...>, '200 OK', Headers(...))
+
+        See `route` for the optional `etag` function.
         """
-        return self.route(string, ("GET",))
+        return self.route(string, ("GET",), etag=etag)
 
     def POST(self, string):
         """Shorthand for registering POST requests."""
@@ -218,35 +304,421 @@ class API:
     def __call__(self, environ, start_response):
         try:
             request = werkzeug.Request(environ)
-            adapter = self._url_map.bind_to_environ(environ)
-            endpoint, values = adapter.match()
-
-            # Dispatch request
-            response = endpoint(request, **values)
-            if not callable(response):
-                response = _json_response(response)
+            endpoint, values, etag, response = self._match(request, environ)
+            if response is None:
+                response = self._make_response(endpoint(request, **values), etag)
             return response(environ, start_response)
-        except HTTPException as e:
+        except Exception as e:
+            response = self._error_response(e, environ["wsgi.errors"])
+        return response(environ, start_response)
+
+    def _match(self, request, environ):
+        """Find the handler for a request.
+
+        Returns the handler, its URL values and entity tag, and a 304 Not
+        Modified response if the handler does not need to be called.
+        """
+        adapter = self._url_map.bind_to_environ(environ)
+        endpoint, values = adapter.match()
+
+        # Conditional request: skip the handler if the client is up to date
+        etag = self._etags.get(endpoint)
+        if etag is not None:
+            etag = etag(request, **values)
+            if etag is not None and request.if_none_match.contains_weak(etag):
+                return endpoint, values, etag, _json_response(None, status=304, etag=etag)
+        return endpoint, values, etag, None
+
+    def _make_response(self, response, etag=None):
+        if not callable(response):
+            return _json_response(response, etag=etag, compact=self.compact)
+        elif etag is not None and isinstance(response, werkzeug.Response):
+            response.set_etag(etag)
+        return response
+
+    def _error_response(self, e, err):
+        if isinstance(e, HTTPException):
             response = _json_response(
                 {"code": e.code, "name": e.name, "description": e.description},
                 status=e.code,
+                compact=self.compact,
             )
+            # e.g. Retry-After of 503 Service Unavailable
+            for name, value in e.get_headers():
+                if name.lower() != "content-type":
+                    response.headers.add(name, value)
+            return response
+        print(f"ERROR {e.__class__.__name__}: {str(e)}", file=err)
+        traceback.print_exc(file=err)
+        return _json_response(
+            {"code": 500, "name": "Internal Server Error"},
+            status=500,
+            compact=self.compact,
+        )
+
+
+class AsyncAPI(API):
+    """JSON API for ASGI servers like uvicorn.
+
+    Routes are registered like with `API`, and request bodies are validated
+    the same way. Handlers may be coroutine functions, which run on the
+    event loop. Ordinary functions run in an `executor` (default: the
+    event loop's default executor), so that they cannot block it.
+
+    Response bodies may be async iterators, like the streams of
+    `AsyncPubSub`, which wait for events without occupying a thread.
+
+    >>> import asyncio
+    >>> api = AsyncAPI()
+    >>> @api.GET("/")
+    ... async def root(request):
+    ...     return "Hello World"
+    ...
+    >>> @api.POST("/sum")
+    ... def total(request, numbers:list):
+    ...     return sum(numbers)
+    ...
+
+    A minimal ASGI server for the examples:
+    >>> def call(app, method, path, body=b""):
+    ...     messages = [{"type": "http.request", "body": body}]
+    ...     sent = []
+    ...     async def receive():
+    ...         return messages.pop(0) if messages else {"type": "http.disconnect"}
+    ...     async def send(message):
+    ...         sent.append(message)
+    ...     scope = {"type": "http", "method": method, "path": path,
+    ...              "query_string": b"", "headers": []}
+    ...     asyncio.run(app(scope, receive, send))
+    ...     body = b"".join(message.get("body", b"") for message in sent[1:])
+    ...     return sent[0]["status"], json.loads(body)
+    ...
+    >>> call(api, "GET", "/")
+    (200, 'Hello World')
+    >>> call(api, "POST", "/sum", b'{"numbers": [1, 2, 3]}')
+    (200, 6)
+    >>> call(api, "POST", "/sum", b'{"numbers": "1, 2, 3"}')[0]
+    422
+    >>> call(api, "GET", "/nowhere")[0]
+    404
+    """
+
+    def __init__(self, compact=False, executor=None):
+        super().__init__(compact=compact)
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        elif scope["type"] != "http":
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+        environ = _asgi_environ(scope, await _asgi_body(receive))
+        loop = asyncio.get_running_loop()
+        try:
+            request = werkzeug.Request(environ)
+            endpoint, values, etag, response = self._match(request, environ)
+            if response is None:
+                if inspect.iscoroutinefunction(inspect.unwrap(endpoint)):
+                    response = await endpoint(request, **values)
+                else:
+                    handler = functools.partial(endpoint, request, **values)
+                    response = await loop.run_in_executor(self.executor, handler)
+                response = self._make_response(response, etag)
         except Exception as e:
-            response = _json_response(
-                {"code": 500, "name": "Internal Server Error"}, status=500
+            response = self._error_response(e, environ["wsgi.errors"])
+        await self._send_response(response, environ, receive, send)
+
+    @staticmethod
+    async def _lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _send_response(self, response, environ, receive, send):
+        headers = response.get_wsgi_headers(environ)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [
+                    (key.lower().encode("latin-1"), value.encode("latin-1"))
+                    for key, value in headers.items()
+                ],
+            }
+        )
+        if hasattr(response.response, "__aiter__"):
+            body = response.response
+        elif not response.is_streamed:
+            for chunk in response.get_app_iter(environ):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        else:
+            body = self._iterate_in_executor(response.get_app_iter(environ))
+
+        # Streams end when the client disconnects
+        streaming = asyncio.ensure_future(self._send_body(body, send))
+        disconnected = asyncio.ensure_future(_asgi_disconnected(receive))
+        try:
+            await asyncio.wait(
+                (streaming, disconnected), return_when=asyncio.FIRST_COMPLETED
             )
-            err = environ["wsgi.errors"]
-            print(f"ERROR {e.__class__.__name__}: {str(e)}", file=err)
-            traceback.print_exc(file=err)
-        return response(environ, start_response)
+        finally:
+            streaming.cancel()
+            disconnected.cancel()
+            await asyncio.gather(streaming, disconnected, return_exceptions=True)
+            if hasattr(body, "aclose"):
+                await body.aclose()
+            if body is response.response:
+                # Runs the functions registered with `call_on_close`, like
+                # WSGI servers do when closing the response
+                response.close()
+        if streaming.done() and not streaming.cancelled() and streaming.exception():
+            raise streaming.exception()
+
+    @staticmethod
+    async def _send_body(body, send):
+        async for chunk in body:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _iterate_in_executor(self, app_iter):
+        # Synchronous streams may block while waiting for the next chunk
+        loop = asyncio.get_running_loop()
+        lock = threading.Lock()
+        chunks = iter(app_iter)
+        done = object()
+
+        def step():
+            with lock:
+                return next(chunks, done)
+
+        def close():
+            # Waits for a step still running after the client disconnected
+            with lock:
+                app_iter.close()
+
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.executor, step)
+                if chunk is done:
+                    return
+                yield chunk
+        finally:
+            if hasattr(app_iter, "close"):
+                loop.run_in_executor(self.executor, close)
+
+
+async def _asgi_body(receive):
+    body = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(body)
+
+
+async def _asgi_disconnected(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+def _asgi_environ(scope, body):
+    """Build a WSGI environ for werkzeug from an ASGI http `scope`."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": client[1],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for key, value in scope.get("headers", ()):
+        key = key.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key == "CONTENT_LENGTH":
+            continue
+        elif key != "CONTENT_TYPE":
+            key = "HTTP_" + key
+            if key in environ:
+                value = f"{environ[key]},{value}"
+        environ[key] = value
+    return environ
+
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode("ascii")
+    return str(value)
+
+
+class JSONCodec:
+    """JSON encoding and decoding with Python's standard library.
+
+    Subclasses use faster JSON libraries. The module level `json_codec` is
+    set to the fastest installed one, and may be replaced by any object
+    with the same `dumps` and `loads` methods.
+
+    `dumps` returns UTF-8 encoded bytes. Values unknown to JSON are
+    converted like in `_json_response`: bytes are base64 encoded,
+    everything else (e.g. datetimes) is converted with `str`.
+    >>> codec = JSONCodec()
+    >>> codec.dumps({"date": timestamp("2020-12-09T23:44:53.782Z")}, compact=True)
+    b'{"date":"2020-12-09 23:44:53.782000+00:00"}'
+
+    `loads` parses bytes directly:
+    >>> codec.loads(b'{"numbers": [1, 2, 3]}')
+    {'numbers': [1, 2, 3]}
+
+    All codecs produce the same data:
+    >>> data = {"date": timestamp(), "content": b"Hello", "big": 2 ** 70}
+    >>> json.loads(json_codec.dumps(data)) == json.loads(codec.dumps(data))
+    True
+
+    And parse it like the standard library, including big integers and
+    NaN or Infinity:
+    >>> json_codec.loads(b'[12345678901234567890123, NaN, -Infinity]')
+    [12345678901234567890123, nan, -inf]
+    """
+
+    name = "json"
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def dumps(self, data, compact=False):
+        if compact:
+            data = json.dumps(data, separators=(",", ":"), default=_json_default)
+        else:
+            data = json.dumps(data, indent=2, default=_json_default)
+        return data.encode("utf-8")
+
+    def loads(self, data):
+        if isinstance(data, (bytes, bytearray)):
+            data = str(data, "utf-8")
+        return json.loads(data)
+
+    @staticmethod
+    def _raise_for_utf8(data):
+        # Report invalid UTF-8 like the standard library, not as invalid JSON
+        if isinstance(data, (bytes, bytearray)):
+            str(data, "utf-8")
+
+
+class ORJSONCodec(JSONCodec):
+    """JSON codec using `orjson`."""
+
+    name = "orjson"
+
+    @classmethod
+    def available(cls):
+        return orjson is not None
+
+    def dumps(self, data, compact=False):
+        # Leave datetimes and dataclasses to `_json_default`, like the standard library
+        option = (
+            orjson.OPT_NON_STR_KEYS
+            | orjson.OPT_PASSTHROUGH_DATETIME
+            | orjson.OPT_PASSTHROUGH_DATACLASS
+        )
+        if not compact:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(data, default=_json_default, option=option)
+        except orjson.JSONEncodeError:
+            # e.g. integers larger than 64 bit
+            return super().dumps(data, compact)
+
+    # orjson turns integers beyond 64 bit into floats, which it cannot tell
+    # apart afterwards: such numbers are parsed with the standard library
+    _long_number = re.compile(rb"\d{19}")
+    _long_number_str = re.compile(r"\d{19}")
+
+    def loads(self, data):
+        if isinstance(data, str):
+            long_number = self._long_number_str.search(data)
+        else:
+            long_number = self._long_number.search(data)
+        if long_number is not None:
+            return super().loads(data)
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # e.g. NaN and Infinity, which orjson rejects. Invalid JSON is
+            # reported by the standard library as well.
+            return super().loads(data)
+
+
+class UJSONCodec(JSONCodec):
+    """JSON codec using `ujson`."""
+
+    name = "ujson"
+
+    @classmethod
+    def available(cls):
+        return ujson is not None
+
+    def dumps(self, data, compact=False):
+        try:
+            data = ujson.dumps(
+                data,
+                indent=0 if compact else 2,
+                ensure_ascii=False,
+                escape_forward_slashes=False,
+                default=_json_default,
+            )
+        except (TypeError, OverflowError):
+            # e.g. old ujson versions without the `default` argument
+            return super().dumps(data, compact)
+        return data.encode("utf-8")
+
+    def loads(self, data):
+        try:
+            return ujson.loads(data)
+        except ValueError:
+            self._raise_for_utf8(data)
+            raise
+
+
+json_codec = next(
+    codec() for codec in (ORJSONCodec, UJSONCodec, JSONCodec) if codec.available()
+)
 
 
-def _json_response(data, status=200):
+def _json_response(data, status=200, etag=None, compact=False):
     if data is None:
-        return werkzeug.Response(status=status)
+        response = werkzeug.Response(status=status)
     else:
-        data = json.dumps(data, indent=2, default=str) + "\n"
-        return werkzeug.Response(data, status=status, mimetype="text/json")
+        data = json_codec.dumps(data, compact=compact) + b"\n"
+        response = werkzeug.Response(data, status=status, mimetype="text/json")
+    if etag is not None:
+        # Clients must revalidate, but may reuse their copy on 304 Not Modified
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+    return response
 
 
 def _check_value(key, value, value_type):
@@ -274,27 +746,90 @@ def _check_value(key, value, value_type):
         )
 
 
-def _parse_json_body(func=None, body_type=dict, content_types={}):  # noqa: C901
+def _compile_check(key, value_type):
+    """Return a function checking and converting values like `_check_value`.
+
+    The common annotations get a specialised check, all others fall back to
+    `_check_value`.
+    """
+    type_error = f"Invalid format: '{key}' must be of type {value_type.__name__}."
+
+    if value_type is bool:
+
+        def check(value):
+            if value is True or value is False:
+                return value
+            raise UnprocessableEntity(type_error)
+
+    elif value_type is float:
+
+        def check(value):
+            if isinstance(value, float):
+                return value
+            elif isinstance(value, int):
+                return float(value)
+            raise UnprocessableEntity(type_error)
+
+    elif value_type in (int, str, list, dict):
+
+        def check(value):
+            if isinstance(value, value_type):
+                return value
+            raise UnprocessableEntity(type_error)
+
+    else:
+
+        def check(value):
+            return _check_value(key, value, value_type)
+
+    return check
+
+
+def _parse_json_body(func=None, body_type=dict, content_types={}, fields=None):
+    """Wrap `func` to receive the parsed JSON request body.
+
+    If `fields` is given (or `content_types` for a dict body), the body must
+    be a dict, whose keys are passed as keyword arguments. Otherwise the
+    whole body is passed as the `data` argument.
+
+    The validation plan is compiled once: every allowed key maps to its
+    converter and whether it is required, so that a request only needs a
+    single pass over the body.
+    """
     if func is None:
         return functools.partial(
-            _parse_json_body, body_type=body_type, content_types=content_types
+            _parse_json_body,
+            body_type=body_type,
+            content_types=content_types,
+            fields=fields,
         )
 
-    sig = inspect.signature(func)
+    params = inspect.signature(func).parameters
+    if fields is None and body_type == dict and content_types:
+        fields = list(params)[1:]
+
+    if fields is not None:
+        plan = {
+            key: (
+                _compile_check(key, content_types[key]) if key in content_types else None,
+                params[key].default is inspect.Parameter.empty,
+            )
+            for key in fields
+        }
+        required_count = sum(required for _, required in plan.values())
 
     @functools.wraps(func)
     def wrapper(request, *args, **kwargs):
-        try:
-            data = str(request.data, "utf-8").strip()
-        except UnicodeDecodeError:
-            raise UnsupportedMediaType("Cannot parse request body: invalid UTF-8 data")
-
-        if not data:
+        data = request.data
+        if not data or data.isspace():
             raise UnsupportedMediaType("Cannot parse request body: no data supplied")
 
+        # Parse the bytes directly, without decoding them to a string first
         try:
-            data = json.loads(data)
-        except json.decoder.JSONDecodeError:
+            data = json_codec.loads(data)
+        except UnicodeDecodeError:
+            raise UnsupportedMediaType("Cannot parse request body: invalid UTF-8 data")
+        except ValueError:
             raise UnsupportedMediaType("Cannot parse request body: invalid JSON")
 
         if not isinstance(data, body_type):
@@ -302,26 +837,23 @@ def _parse_json_body(func=None, body_type=dict, content_types={}):  # noqa: C901
                 f"Invalid data format: {body_type.__name__} expected"
             )
 
-        if body_type == dict and content_types:
-            too_many = data.keys() - sig.parameters.keys()
-            if too_many:
-                raise UnprocessableEntity(f"Key not allowed: {', '.join(too_many)}")
-
-            kwargs.update(data)
-            bound = sig.bind_partial(request, *args, **kwargs)
-
-            for key, value in bound.arguments.items():
-                if key in content_types:
-                    bound.arguments[key] = _check_value(key, value, content_types[key])
+        if fields is None:
+            kwargs["data"] = data
+            return func(request, *args, **kwargs)
 
-            bound.apply_defaults()
+        required_found = 0
+        for key, value in data.items():
+            try:
+                check, required = plan[key]
+            except KeyError:
+                too_many = [key for key in data if key not in plan]
+                raise UnprocessableEntity(f"Key not allowed: {', '.join(too_many)}")
+            kwargs[key] = value if check is None else check(value)
+            required_found += required
 
-            missing = sig.parameters.keys() - bound.arguments.keys()
-            if missing:
-                raise UnprocessableEntity(f"Key missing: {', '.join(missing)}")
-
-        else:
-            kwargs["data"] = data
+        if required_found < required_count:
+            missing = [key for key, (_, required) in plan.items() if required and key not in data]
+            raise UnprocessableEntity(f"Key missing: {', '.join(missing)}")
 
         return func(request, *args, **kwargs)
 
@@ -377,6 +909,10 @@ class BaseJWTAuthMiddleware:
 
     Upon successful authentication the username is stored in the WSGI environment,
     and can be retrieved from Werkzeug's Request object: `request.remote_user`
+
+    Verified tokens are cached, so that repeated requests with the same token
+    skip the signature check. Up to `token_cache_size` tokens are kept, each
+    until it expires. Assigning a new `secret` clears the cache.
     """
 
     def __init__(
@@ -387,6 +923,7 @@ class BaseJWTAuthMiddleware:
         exempt=[],
         prefix="/auth",
         login_methods=("POST",),
+        token_cache_size=1_000,
     ):
         if jwt is None:
             print("WARNING: No module named 'jwt'", file=sys.stderr)
@@ -403,14 +940,29 @@ class BaseJWTAuthMiddleware:
         self.app = DispatcherMiddleware(app, {prefix: auth_api})
 
         prefix = prefix.lower().rstrip("/")
-        self.exempt = (
+        self.exempt = frozenset(
             [(method.upper(), path.lower().rstrip("/")) for method, path, *_ in exempt]
             + [(method.upper(), prefix + "/login") for method in login_methods]
             + [("POST", prefix + "/renew")]
         )
 
+        self.token_cache_size = token_cache_size
+        # token -> (username, expiration time), least recently used first
+        self._token_cache = collections.OrderedDict()
+        self._token_cache_lock = threading.Lock()
         self.secret = secret
 
+    @property
+    def secret(self):
+        return self._secret
+
+    @secret.setter
+    def secret(self, secret):
+        # Tokens verified with the old secret must be verified again
+        with self._token_cache_lock:
+            self._secret = secret
+            self._token_cache.clear()
+
     def __call__(self, environ, start_response):
         try:
             request_line = (
@@ -456,10 +1008,20 @@ class BaseJWTAuthMiddleware:
             raise Unauthorized("Invalid authorization header")
 
         token = auth[len("Bearer ") :]
+        with self._token_cache_lock:
+            secret = self._secret
+            cached = self._token_cache.get(token)
+            if cached is not None:
+                username, expires = cached
+                if time.time() < expires:
+                    self._token_cache.move_to_end(token)
+                    return username
+                del self._token_cache[token]
+
         try:
             claims = jwt.decode(
                 token,
-                self.secret,
+                secret,
                 algorithms=["HS256"],
                 options={"require_exp": True, "require_iat": True},
             )
@@ -467,7 +1029,15 @@ class BaseJWTAuthMiddleware:
             raise Unauthorized("Expired token")
         except jwt.InvalidTokenError:
             raise Unauthorized("Invalid token")
-        return claims["username"]
+
+        username = claims["username"]
+        with self._token_cache_lock:
+            # Unless the secret was changed during the check
+            if self.token_cache_size > 0 and secret is self._secret:
+                self._token_cache[token] = (username, claims["exp"])
+                if len(self._token_cache) > self.token_cache_size:
+                    self._token_cache.popitem(last=False)
+        return username
 
     def _login(self, request):
         username = self.authenticate(request)
@@ -578,6 +1148,11 @@ class DummyAuth(BaseJWTAuthMiddleware):
     >>> headers = {"Authorization": f"Bearer {token}"}
     >>> client.get("/", headers=headers)                           # doctest: +ELLIPSIS
     (<werkzeug.wsgi.ClosingIterator ...>, '200 OK', Headers(...))
+
+    After changing the secret, the token is not valid anymore:
+    >>> app.secret = "another secret"
+    >>> client.get("/", headers=headers)                           # doctest: +ELLIPSIS
+    (<werkzeug.wsgi.ClosingIterator ...>, '401 UNAUTHORIZED', Headers(...))
     """
 
     def authenticate(self, request):
@@ -625,6 +1200,22 @@ class UsernamePasswordAuth(BaseJWTAuthMiddleware):
     >>> body, code, *_ = client.post("/auth/login", json=cred)
     >>> code
     '401 UNAUTHORIZED'
+
+    Users registering after a failed login can log in right away:
+    >>> db['user'].insert(dict(username="yoko", password=crypt.crypt("john")))
+    2
+    >>> body, code, *_ = client.post("/auth/login", json=cred)
+    >>> code
+    '200 OK'
+
+    Passwords are checked by at most `hash_workers` threads, with up to
+    `hash_queue_size` further logins waiting for them. The thread handling
+    the request still waits for the hash, so the executor bounds the CPU
+    used for hashing, not the request threads: further logins are rejected
+    with 503 Service Unavailable, instead of occupying all threads of the
+    server. The password hashes found by `find_password` are cached for
+    `password_cache_ttl` seconds, unknown users are looked up again on the
+    next login.
     """
 
     def __init__(
@@ -637,6 +1228,11 @@ class UsernamePasswordAuth(BaseJWTAuthMiddleware):
         exempt=[],
         prefix="/auth",
         login_methods=("POST",),
+        token_cache_size=1_000,
+        hash_workers=None,
+        hash_queue_size=64,
+        password_cache_ttl=10,
+        password_cache_size=1_000,
     ):
         """Initialize the authentication middleware
 
@@ -651,7 +1247,12 @@ class UsernamePasswordAuth(BaseJWTAuthMiddleware):
         `find_password`.
         """
         super().__init__(
-            app, secret, exempt=exempt, prefix=prefix, login_methods=login_methods
+            app,
+            secret,
+            exempt=exempt,
+            prefix=prefix,
+            login_methods=login_methods,
+            token_cache_size=token_cache_size,
         )
         if user_table is not None:
 
@@ -666,27 +1267,1038 @@ class UsernamePasswordAuth(BaseJWTAuthMiddleware):
         else:
             raise ValueError("One of 'user_table' and 'find_password' must be supplied")
 
+        hash_workers = hash_workers or os.cpu_count() or 1
+        # Threads are only started by the first login, i.e. after forking
+        self._hash_executor = concurrent.futures.ThreadPoolExecutor(
+            hash_workers, thread_name_prefix="UsernamePasswordAuth"
+        )
+        self._hash_slots = threading.BoundedSemaphore(hash_workers + hash_queue_size)
+
+        self.password_cache_ttl = password_cache_ttl
+        self.password_cache_size = password_cache_size
+        # username -> (password hash, expiration time), least recently used first
+        self._password_cache = collections.OrderedDict()
+        self._password_cache_lock = threading.Lock()
+
     def authenticate(self, request):
         @_parse_json_body(content_types=dict(username=str, password=str))
         def handler(request, username, password):
-            pw_hash = self.find_password(username)
-            if pw_hash and crypt.crypt(password, pw_hash) == pw_hash:
+            # Database connections may be bound to the thread, so only the
+            # hashing runs in the executor
+            pw_hash = self._cached_find_password(username)
+            if not pw_hash:
+                return None
+
+            if not self._hash_slots.acquire(blocking=False):
+                raise ServiceUnavailable("Too many logins, try again later", retry_after=1)
+            try:
+                future = self._hash_executor.submit(crypt.crypt, password, pw_hash)
+            except BaseException:
+                self._hash_slots.release()
+                raise
+            future.add_done_callback(lambda future: self._hash_slots.release())
+            # Blocks this thread, the executor only limits concurrent hashing
+            if future.result() == pw_hash:
                 return username
 
         return handler(request)
 
+    def _cached_find_password(self, username):
+        with self._password_cache_lock:
+            cached = self._password_cache.get(username)
+            if cached is not None:
+                pw_hash, expires = cached
+                if time.monotonic() < expires:
+                    self._password_cache.move_to_end(username)
+                    return pw_hash
+                del self._password_cache[username]
+
+        pw_hash = self.find_password(username)
+        # Not cached when unknown, the user may register right after
+        if pw_hash is not None and self.password_cache_ttl > 0:
+            with self._password_cache_lock:
+                self._password_cache[username] = (
+                    pw_hash,
+                    time.monotonic() + self.password_cache_ttl,
+                )
+                if len(self._password_cache) > self.password_cache_size:
+                    self._password_cache.popitem(last=False)
+        return pw_hash
+
+
+class _KeepAliveRequestHandler(werkzeug.serving.WSGIRequestHandler):
+    """Request handler keeping HTTP/1.1 connections open between requests.
+
+    Unread request bodies are drained, so that the next request on the same
+    connection starts at the right place. Idle connections are closed after
+    the server's `keep_alive` timeout.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        self.timeout = self.server.keep_alive
+        super().setup()
+        # Headers and body are written separately. With Nagle's algorithm,
+        # the body would wait for the client's delayed ACK (~40 ms) on every
+        # response of a kept-alive connection.
+        if self.connection.family in (socket.AF_INET, socket.AF_INET6):
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def make_environ(self):
+        environ = super().make_environ()
+        if environ.get("wsgi.input_terminated"):
+            # Chunked request bodies cannot be skipped cheaply
+            self._input = None
+            self.close_connection = True
+        else:
+            try:
+                length = max(int(environ.get("CONTENT_LENGTH") or 0), 0)
+            except ValueError:
+                length = 0
+                self.close_connection = True
+            self._input = werkzeug.wsgi.LimitedStream(environ["wsgi.input"], length)
+            environ["wsgi.input"] = self._input
+        return environ
+
+    def handle_one_request(self):
+        self._input = None
+        if not self.server._wait_for_request(self.connection, self.rfile, self.timeout):
+            self.close_connection = True
+            return
+        super().handle_one_request()
+        if self.server.stopping.is_set() or not self.server._connections.empty():
+            # Idle connections must not hold threads others are waiting for
+            self.close_connection = True
+        elif self._input is not None and not self.close_connection:
+            self._input.exhaust()
+
+
+def _buffered(connection, rfile):
+    """Return whether bytes can be read from `rfile` without waiting."""
+    # peek only reads from the socket when the buffer is empty, and does
+    # not wait for data in non-blocking mode
+    timeout = connection.gettimeout()
+    try:
+        connection.setblocking(False)
+        return bool(rfile.peek(1))
+    except (OSError, ValueError):  # Closed meanwhile
+        return False
+    finally:
+        try:
+            connection.settimeout(timeout)
+        except OSError:
+            pass
+
+
+class _PooledWSGIServer(werkzeug.serving.BaseWSGIServer):
+    """WSGI server handling connections in a fixed pool of `threads`.
+
+    Accepted connections wait in a bounded queue for a free thread. When
+    the queue is full, new connections stay in the listen backlog of the
+    operating system instead of spawning ever more threads.
+
+    Streams (responses without a `Content-Length`, which end with their
+    connection) would hold a thread of the pool for as long as they are
+    connected. Their thread leaves the pool instead, and a new one takes
+    its place. It ends together with the stream.
+
+    Connections waiting for a (further) request hold a thread as well. They
+    are closed when a new connection finds no free thread.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads=32, keep_alive=5):
+        super().__init__(host, port, app, handler=_KeepAliveRequestHandler)
+        self.application = app
+        self.app = self._serve_application
+        self.threads = threads
+        self.keep_alive = keep_alive
+        self.stopping = threading.Event()
+        self._connections = queue.Queue(maxsize=threads)
+        self._workers = []
+        self._detached = set()
+        self._workers_lock = threading.Lock()
+        self._free_workers = 0
+        self._idle = set()
+
+    def serve_forever(self, poll_interval=0.5):
+        # Threads do not survive a fork, so they are only started here
+        with self._workers_lock:
+            for _ in range(self.threads):
+                self._start_worker()
+        # Unlike BaseWSGIServer, do not close the server when the loop ends
+        socketserver.BaseServer.serve_forever(self, poll_interval)
+
+    def _start_worker(self):
+        worker = threading.Thread(target=self._work, daemon=True)
+        self._workers.append(worker)
+        worker.start()
+
+    def _serve_application(self, environ, start_response):
+        def detaching_start_response(status, headers, exc_info=None):
+            # The same condition as werkzeug's for closing the connection
+            # after the response
+            code = int(status.split(None, 1)[0])
+            if not (
+                any(key.lower() == "content-length" for key, _ in headers)
+                or environ["REQUEST_METHOD"] == "HEAD"
+                or code < 200
+                or code in (204, 304)
+            ):
+                self._detach()
+            return start_response(status, headers, exc_info)
+
+        return self.application(environ, detaching_start_response)
+
+    def _detach(self):
+        # Replaces the current thread in the pool
+        thread = threading.current_thread()
+        with self._workers_lock:
+            if thread in self._detached or self.stopping.is_set():
+                return
+            self._detached.add(thread)
+            self._start_worker()
+
+    def process_request(self, request, client_address):
+        if self._free_workers == 0:
+            self._close_idle()
+        while not self.stopping.is_set():
+            try:
+                self._connections.put((request, client_address), timeout=0.5)
+                return
+            except queue.Full:
+                pass
+        self.shutdown_request(request)
+
+    def _wait_for_request(self, connection, rfile, timeout):
+        # Pipelined requests may already be in the buffer of `rfile`, where
+        # select does not see them
+        if _buffered(connection, rfile):
+            return True
+        with self._workers_lock:
+            self._idle.add(connection)
+        try:
+            return bool(select.select([connection], [], [], timeout)[0])
+        except (OSError, ValueError):  # Closed meanwhile
+            return False
+        finally:
+            with self._workers_lock:
+                self._idle.discard(connection)
+
+    def _close_idle(self):
+        # The waiting threads see the end of the connection and return to the pool
+        with self._workers_lock:
+            for connection in self._idle:
+                try:
+                    connection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+
+    def _work(self):
+        while True:
+            with self._workers_lock:
+                self._free_workers += 1
+            item = self._connections.get()
+            with self._workers_lock:
+                self._free_workers -= 1
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+            thread = threading.current_thread()
+            if thread in self._detached:
+                with self._workers_lock:
+                    self._detached.discard(thread)
+                    self._workers.remove(thread)
+                return
+
+    def close(self, timeout=10):
+        """Stop accepting connections and wait up to `timeout` seconds for the
+        requests in progress to finish."""
+        self.stopping.set()
+        self.socket.close()
+        deadline = time.monotonic() + timeout
+        try:
+            # One for each thread of the pool, detached ones end by themselves
+            for _ in range(self.threads):
+                self._connections.put(None, timeout=max(deadline - time.monotonic(), 0))
+        except queue.Full:
+            pass
+        with self._workers_lock:
+            workers = list(self._workers)
+        for worker in workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+        self._workers = []
+
+    def server_close(self):
+        self.close(timeout=0)
+
+
+def _serve_gracefully(server, timeout):
+    """Serve until SIGTERM or SIGINT, then finish open requests."""
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever, so it cannot run in this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    in_main_thread = threading.current_thread() is threading.main_thread()
+    if in_main_thread:
+        previous = {
+            signum: signal.signal(signum, stop) for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+    try:
+        server.serve_forever()
+    finally:
+        server.close(timeout)
+        if in_main_thread:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
 
-def run(app, port=3000, hostname="localhost"):
+def _serve_preforked(server, workers, timeout):
+    """Fork `workers` processes sharing the listening socket of `server`.
+
+    Crashed workers are replaced. On SIGTERM or SIGINT, the workers are
+    asked to shut down and the parent waits for them.
+    """
+    # Idle workers must not block in accept() when another one got the connection
+    server.socket.setblocking(False)
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            # The signal handlers are replaced in _serve_gracefully
+            children.clear()
+            code = 0
+            try:
+                _serve_gracefully(server, timeout)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    previous = {signum: signal.signal(signum, stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        for _ in range(workers):
+            spawn()
+        while children:
+            pid, status = os.wait()
+            children.discard(pid)
+            if not stopping:
+                server.log("warning", " * Worker %d exited (status %d), restarting", pid, status)
+                spawn()
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        server.socket.close()
+
+
+def run(
+    app,
+    port=3000,
+    hostname="localhost",
+    mode="development",
+    workers=1,
+    threads=32,
+    keep_alive=5,
+    shutdown_timeout=10,
+):
     """Run a wsgi application like an API.
 
     Optionally specify a listening `port` (default: 3000) and a bind
     `hostname` (default: localhost). Set the hostname to the empty string,
     to listen on all interfaces.
+
+    In the default "development" `mode`, the werkzeug development server is
+    used with a reloader and a new thread per request.
+
+    In "production" `mode`, connections are served by a fixed pool of
+    `threads` per process and kept open for further requests (HTTP/1.1
+    keep-alive) for up to `keep_alive` seconds. With `workers` > 1, that
+    many processes are forked, sharing one listening socket. Every process
+    has its own copy of the application, so state shared between requests
+    must live outside of it. Open streams (like `PubSub.streaming_response`)
+    get a thread of their own outside of the pool, so that they do not keep
+    other requests waiting. Kept-alive connections are closed early when
+    other connections wait for a thread.
+
+    SIGTERM and SIGINT stop accepting new connections and let requests in
+    progress finish for up to `shutdown_timeout` seconds.
     """
-    werkzeug.run_simple(hostname, port, app, threaded=True, use_reloader=True)
+    if mode == "development":
+        werkzeug.run_simple(hostname, port, app, threaded=True, use_reloader=True)
+        return
+    elif mode != "production":
+        raise ValueError(f"Unknown mode: {mode!r}")
+    if workers > 1 and not hasattr(os, "fork"):
+        raise ValueError("Multiple workers need os.fork, which is not available")
+
+    server = _PooledWSGIServer(hostname, port, app, threads=threads, keep_alive=keep_alive)
+    server.log(
+        "info",
+        " * Running on http://%s:%d/ (%d workers, %d threads each)",
+        hostname or "0.0.0.0",
+        server.port,
+        workers,
+        threads,
+    )
+    if workers > 1:
+        _serve_preforked(server, workers, shutdown_timeout)
+    else:
+        _serve_gracefully(server, shutdown_timeout)
+
 
+class Compress:
+    """Middleware compressing responses with gzip or deflate.
 
-Event = collections.namedtuple("Event", ["id", "event_type", "data"])
+    The encoding is negotiated with the client's `Accept-Encoding` header.
+    Only responses with a textual or JSON content type are compressed, and
+    only if their `Content-Length` reaches `threshold` bytes. Empty bodies
+    and responses to HEAD requests are not compressed. The compressed
+    body is sent with its new `Content-Length`, so that the connection can
+    be kept alive. Responses of unknown length, like server-sent event
+    streams, are always compressed and flushed after each chunk, so that
+    events are not held back.
+
+    >>> api = API()
+    >>> @api.GET("/")
+    ... def root(request):
+    ...     return "Hello World! " * 100
+    ...
+    >>> app = Compress(api, threshold=500)
+    >>> from werkzeug.test import Client
+    >>> client = Client(app)
+    >>> body, code, headers = client.get("/", headers={"Accept-Encoding": "gzip"})
+    >>> headers["Content-Encoding"], headers["Vary"]
+    ('gzip', 'Accept-Encoding')
+    >>> body = list(body)
+    >>> headers["Content-Length"] == str(len(b"".join(body)))
+    True
+    >>> import gzip
+    >>> json.loads(gzip.decompress(b"".join(body)))[:12]
+    'Hello World!'
+
+    Clients not accepting a supported encoding get the uncompressed response:
+    >>> body, code, headers = client.get("/", headers={"Accept-Encoding": "br"})
+    >>> "Content-Encoding" in headers, headers["Vary"]
+    (False, 'Accept-Encoding')
+
+    Responses to HEAD requests have no body and are left alone:
+    >>> body, code, headers = client.head("/", headers={"Accept-Encoding": "gzip"})
+    >>> "Content-Encoding" in headers, b"".join(body)
+    (False, b'')
+
+    Streams are flushed chunk by chunk:
+    >>> chat = PubSub()
+    >>> @api.GET("/events")
+    ... def events(request):
+    ...     return chat.streaming_response(request)
+    ...
+    >>> chat.publish("message", "hello")
+    >>> chat.publish("message", "world")
+    >>> headers = {"Accept-Encoding": "deflate", "Last-Event-ID": "0"}
+    >>> body, code, headers = client.get("/events", headers=headers)
+    >>> headers["Content-Encoding"]
+    'deflate'
+    >>> decompressor = zlib.decompressobj()
+    >>> decompressor.decompress(next(body))
+    b': connected\\n\\n'
+    >>> print(decompressor.decompress(next(body)).decode().strip())
+    id: 1
+    event: message
+    data: "world"
+    """
+
+    encodings = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+    def __init__(self, app, threshold=1024, level=6):
+        self.app = app
+        self.threshold = threshold
+        self.level = level
+
+    def __call__(self, environ, start_response):
+        accept = werkzeug.http.parse_accept_header(
+            environ.get("HTTP_ACCEPT_ENCODING", "")
+        )
+        encoding = accept.best_match(self.encodings)
+        if environ["REQUEST_METHOD"] == "HEAD":
+            encoding = None
+        state = {"compressor": None, "streaming": False, "deferred": None}
+
+        def compressing_start_response(status, headers, exc_info=None):
+            headers = werkzeug.datastructures.Headers(headers)
+            # The response differs by Accept-Encoding, even when not compressed
+            vary = werkzeug.http.parse_set_header(headers.get("Vary"))
+            vary.add("Accept-Encoding")
+            headers["Vary"] = vary.to_header()
+
+            if encoding is not None and self._compressible(status, headers):
+                state["compressor"] = zlib.compressobj(
+                    self.level, zlib.DEFLATED, self.encodings[encoding]
+                )
+                state["streaming"] = "Content-Length" not in headers
+                headers["Content-Encoding"] = encoding
+                headers.remove("Content-Length")
+                # The compressed body is a different representation
+                etag, weak = werkzeug.http.unquote_etag(headers.get("ETag"))
+                if etag is not None and not weak:
+                    headers["ETag"] = werkzeug.http.quote_etag(etag, weak=True)
+
+                if not state["streaming"]:
+                    # Start the response once the compressed length is known
+                    state["deferred"] = (status, headers, exc_info, start_response)
+                    state["buffer"] = []
+                    return state["buffer"].append
+
+            write = start_response(status, headers.to_wsgi_list(), exc_info)
+            if state["compressor"] is None:
+                return write
+            return lambda data: write(self._compress_chunk(data, state, flush=True))
+
+        app_iter = self.app(environ, compressing_start_response)
+        return self._compress_iter(app_iter, state)
+
+    def _compressible(self, status, headers):
+        if int(status.split(None, 1)[0]) in (204, 304) or "Content-Encoding" in headers:
+            return False
+        if "no-transform" in headers.get("Cache-Control", ""):
+            return False
+        mimetype = headers.get("Content-Type", "").split(";")[0].strip()
+        if not (
+            mimetype.startswith("text/")
+            or mimetype.endswith(("json", "javascript", "xml"))
+        ):
+            return False
+        length = headers.get("Content-Length", type=int)
+        if length == 0:
+            return False
+        return length is None or length >= self.threshold
+
+    @staticmethod
+    def _compress_chunk(data, state, flush):
+        data = state["compressor"].compress(data)
+        if flush:
+            data += state["compressor"].flush(zlib.Z_SYNC_FLUSH)
+        return data
+
+    def _compress_iter(self, app_iter, state):
+        try:
+            for chunk in app_iter:
+                if state["deferred"] is not None:
+                    state["buffer"].append(chunk)
+                elif state["compressor"] is None:
+                    yield chunk
+                else:
+                    chunk = self._compress_chunk(chunk, state, state["streaming"])
+                    if chunk:
+                        yield chunk
+            if state["deferred"] is not None:
+                status, headers, exc_info, start_response = state["deferred"]
+                compressor = state["compressor"]
+                body = compressor.compress(b"".join(state["buffer"])) + compressor.flush()
+                headers["Content-Length"] = str(len(body))
+                start_response(status, headers.to_wsgi_list(), exc_info)
+                yield body
+            elif state["compressor"] is not None:
+                yield state["compressor"].flush()
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+
+
+class Event(collections.namedtuple("Event", ["id", "event_type", "data"])):
+    """A published event.
+
+    The event is encoded as server-sent event only once, and the `frame`
+    is shared by all subscribers and replays:
+    >>> event = Event(7, "message", {"text": "Hello"})
+    >>> event.frame
+    b'id: 7\\nevent: message\\ndata: {"text":"Hello"}\\n\\n'
+    >>> event.frame is event.frame
+    True
+
+    Line breaks in the event type would start new fields of the frame:
+    >>> Event(8, "message\\nid: 9", "Hello").frame
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid event type: 'message\\nid: 9'
+    """
+
+    @staticmethod
+    def check_event_type(event_type):
+        if "\n" in str(event_type) or "\r" in str(event_type):
+            raise ValueError(f"Invalid event type: {event_type!r}")
+
+    @property
+    def frame(self):
+        try:
+            return self.__dict__["frame"]
+        except KeyError:
+            self.check_event_type(self.event_type)
+            # Concurrent first accesses may both encode, with the same result
+            frame = self.__dict__["frame"] = (
+                f"id: {self.id}\n"
+                f"event: {self.event_type}\n"
+                f"data: {json_codec.dumps(self.data, compact=True).decode('utf-8')}\n\n"
+            ).encode("utf-8")
+            return frame
+
+
+class _ReplayLog:
+    """The last `maxlen` events of a topic, searchable by id.
+
+    Event ids increase within a topic, but have gaps where events went to
+    other topics. Ids and events are kept in parallel lists, so that an id
+    can be found by binary search. Trimmed events are removed in batches,
+    which keeps appending O(1) amortized.
+
+    >>> log = _ReplayLog(maxlen=3)
+    >>> for id in (2, 5, 7, 8):
+    ...     log.append(Event(id, "message", id))
+    ...
+    >>> [event.id for event in log.after(5)]
+    [7, 8]
+    >>> log.after(8)
+    []
+
+    Event 2 was trimmed, so the events after event 1 are incomplete:
+    >>> [event.id for event in log.after(2)]
+    [5, 7, 8]
+    >>> log.after(1)
+    Traceback (most recent call last):
+      ...
+    ValueError: Events after 1 are not in event log
+
+    Events can also be removed explicitly:
+    >>> log.remove_before(8)
+    >>> [event.id for event in log.after(7)]
+    [8]
+    >>> log.after(5)
+    Traceback (most recent call last):
+      ...
+    ValueError: Events after 5 are not in event log
+
+    With a `max_age` in seconds, older events are trimmed as well.
+    """
+
+    def __init__(self, maxlen=1_000, max_age=None):
+        self.maxlen = maxlen
+        self.max_age = max_age
+        self.trimmed_id = -1
+        self._ids = []
+        self._events = []
+        self._times = []
+        self._start = 0
+
+    def __len__(self):
+        return len(self._ids) - self._start
+
+    def append(self, event):
+        now = time.time()
+        self._ids.append(event.id)
+        self._events.append(event)
+        self._times.append(now)
+        start = self._start
+        if len(self._ids) - start > self.maxlen:
+            start += 1
+        if self.max_age is not None:
+            while self._times[start] < now - self.max_age:
+                start += 1
+        if start > self._start:
+            self.trimmed_id = self._ids[start - 1]
+            self._start = start
+            if self._start >= self.maxlen:
+                self._delete_trimmed(self._start)
+
+    def _delete_trimmed(self, index):
+        del self._ids[:index]
+        del self._events[:index]
+        del self._times[:index]
+        self._start = 0
+
+    def remove_before(self, id):
+        """Remove the events with ids lower than `id`."""
+        index = bisect.bisect_left(self._ids, id, self._start)
+        if index > self._start:
+            self.trimmed_id = max(self.trimmed_id, self._ids[index - 1])
+            self._delete_trimmed(index)
+
+    def after(self, last_id):
+        """Return the events with ids greater than `last_id`.
+
+        Raises ValueError, if some of them have been trimmed already, or
+        are older than `max_age`.
+        """
+        if last_id < self.trimmed_id:
+            raise ValueError(f"Events after {last_id} are not in event log")
+        index = bisect.bisect_right(self._ids, last_id, self._start)
+        if (
+            self.max_age is not None
+            and index < len(self._ids)
+            and self._times[index] < time.time() - self.max_age
+        ):
+            raise ValueError(f"Events after {last_id} are not in event log")
+        return self._events[index:]
+
+
+def _replayed_ids(replay_events):
+    # Ids of replayed events, which a stream subscribed before the replay
+    # may receive again. Usually the newest ones, but events are dispatched
+    # outside of the main lock and may arrive slightly out of order.
+    return {event.id for event in replay_events}
+
+
+def _hashable_topic(topic):
+    # Tuples become lists in JSON
+    return tuple(topic) if isinstance(topic, list) else topic
+
+
+def _topic_list(topic=None, topics=None):
+    return [topic] if topics is None else list(dict.fromkeys(topics))
+
+
+class _Segment:
+    """A file of a `_DurableLog`, with the ids and offsets of its events."""
+
+    def __init__(self, path, first_id, started=None):
+        self.path = path
+        self.first_id = first_id
+        self.ids = array.array("q")
+        self.offsets = array.array("q")
+        self.size = 0
+        # Times of the first and the newest event
+        self.started = self.modified = time.time() if started is None else started
+
+
+class _DurableLog:
+    """Append-only log of published events in segment files of `directory`.
+
+    Every event is a line "<id>\\t<time>\\t<JSON [topics, event_type, data]>".
+    A new segment is started when the current one reaches `segment_size`
+    bytes, and only the newest `segments` are kept. Segments are read
+    through memory maps, and an index of every segment maps event ids to
+    offsets.
+
+    With a `max_age` in seconds, events older than that are not returned
+    anymore. A new segment is also started every `max_age` / 8 seconds, and
+    segments are removed once their newest event is older than `max_age`,
+    so that no event stays on disk for longer than 1.25 × `max_age`.
+
+    >>> import tempfile
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> log = _DurableLog(directory.name)
+    >>> for id in range(3):
+    ...     log.append(id, ["chat"], "message", f"Hello {id}")
+    ...
+    >>> log.close()
+
+    The log continues after a restart:
+    >>> log = _DurableLog(directory.name)
+    >>> log.next_id
+    3
+    >>> log.after(0, ["chat"])
+    [Event(id=1, event_type='message', data='Hello 1'), Event(id=2, event_type='message', data='Hello 2')]
+
+    After a `reset`, the earlier events are gone, also after a restart:
+    >>> log.reset(3)
+    >>> log.append(3, ["chat"], "clear", None)
+    >>> log.close()
+    >>> log = _DurableLog(directory.name)
+    >>> log.next_id
+    4
+    >>> log.after(2, ["chat"])
+    [Event(id=3, event_type='clear', data=None)]
+    >>> log.after(1, ["chat"])
+    Traceback (most recent call last):
+      ...
+    ValueError: Events after 1 are not in event log
+    >>> log.close()
+    >>> directory.cleanup()
+    """
+
+    def __init__(self, directory, segment_size=4 * 2 ** 20, segments=16, max_age=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = segments
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._maps = {}
+        self._file = None
+
+        self._segments = [
+            self._load(os.path.join(directory, name))
+            for name in sorted(os.listdir(directory))
+            if name.endswith(".log")
+        ]
+        self._first_ids = [segment.first_id for segment in self._segments]
+        self.next_id = 0
+        if self._segments:
+            # The newest segment is empty after `reset`
+            newest = self._segments[-1]
+            self.next_id = newest.ids[-1] + 1 if newest.ids else newest.first_id
+        if max_age is not None:
+            self.expire()
+            threading.Thread(target=self._expire_periodically, daemon=True).start()
+
+    @staticmethod
+    def _load(path):
+        with open(path, "rb") as f:
+            data = f.read()
+        # The time of the first event is not known, the newest one is
+        # earlier than the start of a new segment would have been
+        segment = _Segment(path, int(os.path.basename(path)[:-4]), os.path.getmtime(path))
+        offset = 0
+        while True:
+            end = data.find(b"\n", offset)
+            if end == -1:
+                break
+            try:
+                id = int(data[offset : data.index(b"\t", offset, end)])
+            except ValueError:
+                break
+            segment.ids.append(id)
+            segment.offsets.append(offset)
+            offset = end + 1
+        if offset < len(data):
+            # Remove an event that was only partially written
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+        segment.size = offset
+        return segment
+
+    def append(self, id, topics, event_type, data):
+        """Append an event. Ids must be increasing."""
+        self.append_record(id, json_codec.dumps([topics, event_type, data], compact=True))
+
+    def append_record(self, id, record):
+        """Append an event already encoded as JSON [topics, event_type, data]."""
+        now = time.time()
+        line = b"%d\t%d\t" % (id, now) + record + b"\n"
+        with self._lock:
+            if (
+                not self._segments
+                or self._segments[-1].size >= self.segment_size
+                or (
+                    self.max_age is not None
+                    and self._segments[-1].ids
+                    and now - self._segments[-1].started >= self.max_age / 8
+                )
+            ):
+                self._start_segment(id)
+            elif self._file is None:
+                self._file = open(self._segments[-1].path, "ab", buffering=0)
+            segment = self._segments[-1]
+            self._file.write(line)
+            segment.ids.append(id)
+            segment.offsets.append(segment.size)
+            segment.size += len(line)
+            segment.modified = now
+            self.next_id = id + 1
+
+    def expire(self):
+        """Remove the segments whose newest event is older than `max_age`."""
+        with self._lock:
+            cutoff = time.time() - self.max_age
+            count = 0
+            for segment in self._segments:
+                if segment.modified >= cutoff:
+                    break
+                count += 1
+            if count == len(self._segments) and count:
+                # An empty segment keeps `next_id` across restarts
+                if self._segments[-1].ids:
+                    self._start_segment(self.next_id)
+                count = len(self._segments) - 1
+            self._remove_segments(count)
+
+    def _expire_periodically(self):
+        while not self._closed.wait(self.max_age / 8):
+            self.expire()
+
+    def reset(self, next_id):
+        """Remove all events. The next event appended must have `next_id`."""
+        with self._lock:
+            # The new segment keeps `next_id` across restarts
+            if not self._segments or self._segments[-1].first_id != next_id:
+                self._start_segment(next_id)
+            self._remove_segments(len(self._segments) - 1)
+            self.next_id = next_id
+
+    def _start_segment(self, first_id):
+        if self._file is not None:
+            self._file.close()
+        path = os.path.join(self.directory, f"{first_id:020d}.log")
+        self._file = open(path, "ab", buffering=0)
+        self._segments.append(_Segment(path, first_id))
+        self._first_ids.append(first_id)
+        self._remove_segments(len(self._segments) - self.max_segments)
+
+    def _remove_segments(self, count):
+        # The oldest ones
+        for _ in range(count):
+            segment = self._segments.pop(0)
+            self._first_ids.pop(0)
+            mm = self._maps.pop(segment.path, None)
+            if mm is not None:
+                mm.close()
+            os.remove(segment.path)
+
+    def _map(self, segment):
+        # The newest segment grows, its map is renewed when needed
+        mm = self._maps.get(segment.path)
+        if mm is None or len(mm) < segment.size:
+            if mm is not None:
+                mm.close()
+            with open(segment.path, "rb") as f:
+                mm = self._maps[segment.path] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ
+                )
+        return mm
+
+    def after(self, last_id, topics=(None,)):
+        """Return the events of `topics` with ids greater than `last_id`.
+
+        Raises ValueError, if some of them have been removed already.
+        """
+        with self._lock:
+            if last_id >= self.next_id or (
+                self._segments and last_id < self._segments[0].first_id - 1
+            ):
+                raise ValueError(f"Events after {last_id} are not in event log")
+            index = max(bisect.bisect_right(self._first_ids, last_id) - 1, 0)
+
+            # Copy the bytes of the following events, parse them without the lock
+            chunks = []
+            start = None
+            for segment in self._segments[index:]:
+                if start is None:
+                    position = bisect.bisect_right(segment.ids, last_id)
+                    start = segment.offsets[position] if position < len(segment.ids) else segment.size
+                if start < segment.size:
+                    chunks.append(self._map(segment)[start : segment.size])
+                start = 0
+
+        topics = set(topics)
+        events = []
+        first = True
+        for chunk in chunks:
+            for line in chunk.splitlines():
+                id, published, record = line.split(b"\t", 2)
+                expired = first and self.max_age is not None and (
+                    int(published) < time.time() - self.max_age
+                )
+                if expired:
+                    raise ValueError(f"Events after {last_id} are not in event log")
+                first = False
+                event_topics, event_type, data = json_codec.loads(record)
+                if not topics.isdisjoint(map(_hashable_topic, event_topics)):
+                    events.append(Event(int(id), event_type, data))
+        return events
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            for mm in self._maps.values():
+                mm.close()
+            self._maps.clear()
+
+
+class _Subscriber:
+    """Bounded event queue of a subscription.
+
+    When the queue is full, the `policy` decides what happens:
+    "disconnect" ends the subscription, "drop-oldest" discards the oldest
+    queued event, and "coalesce" discards a queued event of the same type
+    (or else the oldest one), for events that supersede earlier ones.
+    """
+
+    policies = ("disconnect", "drop-oldest", "coalesce")
+
+    def __init__(self, maxsize=100, policy="disconnect"):
+        if policy not in self.policies:
+            raise ValueError(f"Unknown policy: {policy!r}")
+        self.events = collections.deque()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.closed = False
+
+    def _offer(self, event):
+        """Queue `event`, return the number of dropped events.
+
+        Raises `queue.Full` when the subscriber has to be disconnected.
+        """
+        dropped = 0
+        if len(self.events) >= self.maxsize:
+            if self.policy == "disconnect":
+                self.closed = True
+                raise queue.Full()
+            dropped = 1
+            if self.policy == "coalesce":
+                for index, queued in enumerate(self.events):
+                    if queued.event_type == event.event_type:
+                        del self.events[index]
+                        break
+                else:
+                    self.events.popleft()
+            else:
+                self.events.popleft()
+        self.events.append(event)
+        return dropped
+
+
+class _ThreadSubscriber(_Subscriber):
+    """Subscriber read by a thread."""
+
+    def __init__(self, maxsize=100, policy="disconnect"):
+        super().__init__(maxsize, policy)
+        self._condition = threading.Condition(threading.Lock())
+
+    def put_nowait(self, event):
+        with self._condition:
+            try:
+                return self._offer(event)
+            finally:
+                self._condition.notify()
+
+    def close(self):
+        """End the subscription after the queued events, from any thread."""
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """Return the next event, or None after `timeout` seconds or when closed."""
+        with self._condition:
+            if not self.events and not self.closed:
+                self._condition.wait(timeout)
+            return self.events.popleft() if self.events else None
 
 
 class PubSub:
@@ -711,112 +2323,424 @@ class PubSub:
     Event(id=1, event_type='new_user', data='guido')
     >>> next(nerd_room)
     Event(id=2, event_type='message', data='Hi geeks!')
+
+    An event can be published to several topics, and a subscription can
+    listen to several topics. Every subscriber receives an event only once:
+    >>> inbox = chat.subscribe(topics=["alice", "general"])
+    >>> chat.publish("message", "Hi Bob!", topics=["alice", "bob"])
+    >>> chat.publish("message", "Hi all!", topics=["alice", "general"])
+    >>> next(inbox)
+    Event(id=4, event_type='message', data='Hi Bob!')
+    >>> next(inbox)
+    Event(id=5, event_type='message', data='Hi all!')
+    >>> next(general_room)
+    Event(id=5, event_type='message', data='Hi all!')
+
+    The last `replay_size` events of each topic are kept for clients
+    reconnecting to a `streaming_response`, for at most `replay_max_age`
+    seconds if given.
+
+    `stats` returns the current numbers of subscribers and queued events,
+    and totals of published and dropped events and of the publish latency:
+    >>> stats = chat.stats()
+    >>> stats["subscribers"], stats["queued"], stats["published"]
+    (4, 0, 6)
+
+    Every subscription queues up to `queue_size` events. What happens to
+    subscribers that do not keep up is decided by the `policy`, which can
+    also be chosen per subscription (see `_Subscriber`):
+    >>> presence = PubSub(queue_size=1)
+    >>> status = presence.subscribe(policy="coalesce")
+    >>> for text in ("away", "busy", "online"):
+    ...     presence.publish("status", text)
+    ...
+    >>> next(status)
+    Event(id=2, event_type='status', data='online')
+    >>> presence.stats()["dropped"]
+    2
+
+    Event streams send a comment every `heartbeat` seconds without events.
+
+    Events are only delivered within one process. To share them between
+    several processes (like the `workers` of `run`), start a
+    `PubSubBroker` and pass its address as `broker`. Events published while
+    the connection to the broker is lost are missed: all subscriptions end
+    then, and clients cannot resume until the next event arrives.
+
+    With a `replay_dir`, all events are also written to disk. Event ids then
+    continue after a restart, and clients can resume from events older than
+    the in-memory log. Topics must be JSON-serializable in this case. With a
+    `replay_max_age`, events are removed from disk after at most 1.25 times
+    that many seconds.
+    >>> import tempfile
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> chat = PubSub(replay_dir=directory.name)
+    >>> chat.publish("message", "Before the restart")
+    >>> chat.close()
+    >>> chat = PubSub(replay_dir=directory.name)
+    >>> subscription = chat.subscribe()
+    >>> chat.publish("message", "After the restart")
+    >>> next(subscription)
+    Event(id=1, event_type='message', data='After the restart')
+    >>> chat.close()
+    >>> directory.cleanup()
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        replay_size=1_000,
+        replay_dir=None,
+        broker=None,
+        queue_size=100,
+        policy="disconnect",
+        heartbeat=15,
+        replay_max_age=None,
+    ):
+        if replay_dir is not None and broker is not None:
+            raise ValueError("With a broker, pass the replay_dir to the PubSubBroker")
+        if policy not in _Subscriber.policies:
+            raise ValueError(f"Unknown policy: {policy!r}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.heartbeat = heartbeat
+        self._stats_lock = threading.Lock()
+        self._stats = collections.Counter()
         self._main_lock = threading.Lock()
         self._topic_locks = collections.defaultdict(threading.Lock)
         self._queues = collections.defaultdict(set)
         self._replay_log = collections.defaultdict(
-            lambda: collections.deque(maxlen=1_000)
+            lambda: _ReplayLog(maxlen=replay_size, max_age=replay_max_age)
         )
+        self._durable_log = None
+        next_id = 0
+        if replay_dir is not None:
+            self._durable_log = _DurableLog(replay_dir, max_age=replay_max_age)
+            next_id = self._durable_log.next_id
         # FIXME: not secure?
-        self._current_id = itertools.count()
-
-    def publish(self, event_type, data, topic=None):
+        self._current_id = itertools.count(next_id)
+        # The replay logs contain all events with ids from `_complete_after`
+        # + 1 to `_last_id`, apart from trimmed ones
+        self._last_id = self._complete_after = next_id - 1
+        self._broker = None
+        if broker is not None:
+            # Unknown until the first event from the broker
+            self._complete_after = None
+            self._broker = _BrokerConnection(broker, self._dispatch, self._resync)
+
+    def close(self):
+        """Close the files of the `replay_dir` and the connection to the broker."""
+        if self._durable_log is not None:
+            self._durable_log.close()
+        if self._broker is not None:
+            self._broker.close()
+
+    def publish(self, event_type, data, topic=None, topics=None, reset=False):
         """Publish an event.
 
         The event has an `event_type`, usually a string, and a `data` payload.
         `data` can be free-formed, but should be JSON-serializable.
 
-        Optionally a topic can be specified. The message will be only forwarded
-        to subscribers interested in the specified topic.
+        Optionally a topic can be specified, or a list of `topics`. The message
+        will be only forwarded to subscribers interested in these topics.
+
+        The `event_type` must not contain line breaks.
+
+        With `reset`, all earlier events are removed from the replay logs of
+        all topics, e.g. because this event deletes the data they carry.
+        Clients resuming from before this event get 404 Not Found:
+        >>> chat = PubSub()
+        >>> chat.publish("message", "Secret")
+        >>> chat.publish("clear", None, reset=True)
+        >>> chat._replay_events(0)
+        [Event(id=1, event_type='clear', data=None)]
+        >>> chat._replay_events(-1)
+        Traceback (most recent call last):
+          ...
+        ValueError: Events after -1 are not in event log
+
+        Topics are forgotten once they have neither subscribers nor events
+        to replay, so that topics chosen by clients do not pile up:
+        >>> lobby = chat.subscribe(topic="lobby")
+        >>> chat.publish("message", "Hi", topic="lobby")
+        >>> next(lobby)
+        Event(id=2, event_type='message', data='Hi')
+        >>> lobby.close()
+        >>> "lobby" in chat._replay_log, "lobby" in chat._queues
+        (True, True)
+        >>> chat.publish("clear", None, reset=True)
+        >>> "lobby" in chat._replay_log, "lobby" in chat._queues
+        (False, False)
         """
+        Event.check_event_type(event_type)
+        topics = _topic_list(topic, topics)
+        if self._broker is not None:
+            # The broker assigns the id and sends the event back to all processes
+            self._broker.send(topics, event_type, data, reset)
+            return
+
+        start = time.perf_counter()
         with self._main_lock:
             id = next(self._current_id)
-            queues = self._queues[topic]
-            replay_log = self._replay_log[topic]
-            topic_lock = self._topic_locks[topic]
+            # Written under the main lock, so that the ids on disk are ordered
+            if self._durable_log is not None:
+                if reset:
+                    self._durable_log.reset(id)
+                self._durable_log.append(id, topics, event_type, data)
 
-        to_remove = []
-        event = Event(id, event_type, data)
-
-        with topic_lock:
-            replay_log.append(event)
+        self._dispatch(Event(id, event_type, data), topics, start, reset)
 
-            for q in queues:
-                try:
-                    q.put_nowait(event)
-                except queue.Full:  # Somebody fell asleep?!?
-                    to_remove.append(q)
+    def _dispatch(self, event, topics, start=None, reset=False):
+        if start is None:
+            start = time.perf_counter()
+        with self._main_lock:
+            if self._complete_after is None or reset:
+                self._complete_after = event.id - 1
+            self._last_id = max(self._last_id, event.id)
+            targets = [self._topic(topic) for topic in topics]
+            if reset:
+                replay_logs = [
+                    (topic, replay_log, self._topic_locks[topic])
+                    for topic, replay_log in self._replay_log.items()
+                ]
+
+        if reset:
+            # Later events may have been dispatched already
+            emptied = []
+            for topic, replay_log, topic_lock in replay_logs:
+                with topic_lock:
+                    replay_log.remove_before(event.id)
+                    if not replay_log:
+                        emptied.append(topic)
+            self._forget_topics(emptied)
+
+        dropped = disconnected = 0
+        # Subscribers of several topics get the event only once
+        delivered = set()
+        for topic, (queues, replay_log, topic_lock) in zip(topics, targets):
+            while True:
+                with topic_lock:
+                    # Unless the topic was forgotten after the lookup
+                    if self._replay_log.get(topic) is replay_log:
+                        replay_log.append(event)
+                        counts = self._fan_out(queues, event, delivered)
+                        break
+                with self._main_lock:
+                    queues, replay_log, topic_lock = self._topic(topic)
+            dropped += counts[0]
+            disconnected += counts[1]
+
+        latency = time.perf_counter() - start
+        with self._stats_lock:
+            self._stats["published"] += 1
+            self._stats["dropped"] += dropped
+            self._stats["disconnected"] += disconnected
+            self._stats["publish_time"] += latency
+            if latency > self._stats["publish_time_max"]:
+                self._stats["publish_time_max"] = latency
+
+    def _topic(self, topic):
+        # Called with the main lock held
+        return self._queues[topic], self._replay_log[topic], self._topic_locks[topic]
+
+    def _forget_topics(self, topics):
+        # Topics can be chosen by clients (e.g. user ids), so the entries of
+        # topics without subscribers and replayable events are removed
+        with self._main_lock:
+            for topic in topics:
+                topic_lock = self._topic_locks.get(topic)
+                if topic_lock is None:
+                    continue
+                with topic_lock:
+                    if self._queues.get(topic) or self._replay_log.get(topic):
+                        continue
+                    self._queues.pop(topic, None)
+                    self._replay_log.pop(topic, None)
+                    del self._topic_locks[topic]
+
+    def _resync(self):
+        # Called when the connection to the broker is lost: events published
+        # meanwhile are missed, and a restarted broker may count from 0 again.
+        # Replays are refused until the next event, and subscribers are
+        # disconnected, so that their clients start over.
+        with self._main_lock:
+            self._replay_log.clear()
+            self._last_id = -1
+            self._complete_after = None
+            targets = [(self._queues[topic], self._topic_locks[topic]) for topic in self._queues]
+            topics = list(self._queues)
+        for queues, topic_lock in targets:
+            with topic_lock:
+                subscribers = list(queues)
+                queues.clear()
+            for subscriber in subscribers:
+                subscriber.close()
+        self._forget_topics(topics)
+
+    def _fan_out(self, queues, event, delivered):
+        # Called with the topic lock held
+        dropped = 0
+        to_remove = []
+        for q in queues:
+            if q in delivered:
+                continue
+            delivered.add(q)
+            try:
+                dropped += q.put_nowait(event)
+            except queue.Full:  # Somebody fell asleep?!?
+                to_remove.append(q)
 
-            for q in to_remove:
-                try:
-                    queues.remove(q)
-                except KeyError:
-                    pass
+        for q in to_remove:
+            try:
+                queues.remove(q)
+            except KeyError:
+                pass
+        return dropped, len(to_remove)
+
+    def _count(self, key, value=1):
+        with self._stats_lock:
+            self._stats[key] += value
+
+    def stats(self):
+        """Return counters for sizing the system.
+
+        `subscribers` and `queued` (events waiting in all queues, at most
+        `max_queued` in one) describe the current state. `published`,
+        `dropped` (by the "drop-oldest" and "coalesce" policies),
+        `disconnected` (slow subscribers), and the publish latency in seconds
+        (`publish_latency_avg`, `publish_latency_max`) are totals since the
+        start.
+        """
+        subscribers = set()
+        with self._main_lock:
+            topics = [(self._queues[topic], self._topic_locks[topic]) for topic in self._queues]
+        for queues, topic_lock in topics:
+            with topic_lock:
+                subscribers.update(queues)
+        depths = [len(subscriber.events) for subscriber in subscribers]
+
+        with self._stats_lock:
+            published = self._stats["published"]
+            return {
+                "subscribers": len(depths),
+                "queued": sum(depths),
+                "max_queued": max(depths, default=0),
+                "published": published,
+                "dropped": self._stats["dropped"],
+                "disconnected": self._stats["disconnected"],
+                "publish_latency_avg": self._stats["publish_time"] / published if published else 0.0,
+                "publish_latency_max": self._stats["publish_time_max"],
+            }
 
-    def subscribe(self, topic=None):
+    def subscribe(self, topic=None, policy=None, topics=None):
         """Subscribe to published events.
 
         Events are returned as tripples, containing a unique event `id`, the
         `event_type`, and the payload `data`.
 
-        Optionally a specific `topic` can be specified
+        Optionally a specific `topic` or a list of `topics` can be specified,
+        and a `policy` for a full queue other than the default of the `PubSub`.
         """
-        q = queue.Queue(100)
-        with self._main_lock:
-            queues = self._queues[topic]
-            topic_lock = self._topic_locks[topic]
-
-        with topic_lock:
-            queues.add(q)
+        events = self._subscribe(_topic_list(topic, topics), policy)
 
         def iterator():
-            try:
-                while q in queues:
-                    try:
-                        yield q.get(timeout=60)
-                    except queue.Empty:
-                        pass
-            except GeneratorExit:
-                try:
-                    with topic_lock:
-                        queues.remove(q)
-                except KeyError:
-                    pass
+            with contextlib.closing(events):
+                for event in events:
+                    if event is not None:
+                        yield event
 
         return iterator()
 
-    def _event_stream(self, replay_events=(), topic=None):
-        subscription = self.subscribe(topic)
-        for event in itertools.chain(replay_events, subscription):
-            yield (
-                f"id: {event.id}\n"
-                f"event: {event.event_type}\n"
-                f"data: {json.dumps(event.data, default=str)}\n\n"
-            ).encode("utf-8")
+    def _subscribe(self, topics=(None,), policy=None, timeout=60):
+        subscriber = self._new_subscriber(policy)
+        targets = self._add_subscriber(topics, subscriber)
+        return self._receive(subscriber, targets, timeout)
+
+    def _new_subscriber(self, policy=None):
+        return _ThreadSubscriber(self.queue_size, policy or self.policy)
 
-    def _replay_events(self, last_id, topic=None):
+    def _receive(self, subscriber, targets, timeout):
+        # Yields None after `timeout` seconds without events
+        try:
+            while not subscriber.closed or subscriber.events:
+                yield subscriber.get(timeout)
+        finally:
+            self._remove_subscriber(targets, subscriber)
+
+    def _add_subscriber(self, topics, subscriber):
+        # Under the main lock, so that the topics are not forgotten meanwhile
+        with self._main_lock:
+            targets = [(topic, self._queues[topic], self._topic_locks[topic]) for topic in topics]
+            for topic, queues, topic_lock in targets:
+                with topic_lock:
+                    queues.add(subscriber)
+        return targets
+
+    def _remove_subscriber(self, targets, subscriber):
+        unused = []
+        for topic, queues, topic_lock in targets:
+            with topic_lock:
+                if subscriber in queues:
+                    queues.discard(subscriber)
+                    if not queues:
+                        unused.append(topic)
+        self._forget_topics(unused)
+
+    def _event_stream(self, subscription, replay_events=()):
+        # Sends the response headers right away: browsers only fire `open`
+        # once they arrive, and the client may already rely on being subscribed
+        yield b": connected\n\n"
+        for event in replay_events:
+            yield event.frame
+        replayed = _replayed_ids(replay_events)
+        for event in subscription:
+            if event is None:
+                # Keeps proxies from closing idle connections
+                yield b": heartbeat\n\n"
+            elif event.id not in replayed:
+                yield event.frame
+
+    def _replay_events(self, last_id, topics=(None,)):
         if last_id is None:
             return ()
 
         last_id = int(last_id)
 
         with self._main_lock:
-            replay_log = self._replay_log[topic]
-            topic_lock = self._topic_locks[topic]
-
-        with topic_lock:
-            log_iter = iter(replay_log)
-            for event in log_iter:
-                if event.id == last_id:
-                    break
-            else:
-                raise ValueError(f"{last_id} is not in event log")
-            return list(log_iter)
+            complete = (
+                self._complete_after is not None
+                and self._complete_after <= last_id <= self._last_id
+            )
+            # Topics without a replay log have no events since `_complete_after`
+            targets = [
+                (self._replay_log[topic], self._topic_locks[topic])
+                for topic in topics
+                if topic in self._replay_log
+            ]
 
-    def streaming_response(self, request, topic=None):
+        try:
+            if not complete:
+                raise ValueError(f"Events after {last_id} are not in event log")
+            replays = []
+            for replay_log, topic_lock in targets:
+                # Only the slicing needs the lock, the events themselves are immutable
+                with topic_lock:
+                    replays.append(replay_log.after(last_id))
+        except ValueError:
+            if self._durable_log is None:
+                raise
+            # Older events, or events from before a restart
+            return self._durable_log.after(last_id, topics)
+
+        if len(replays) == 1:
+            return replays[0]
+        # Events published to several of the topics are in several logs
+        events = []
+        for event in heapq.merge(*replays, key=operator.attrgetter("id")):
+            if not events or events[-1].id != event.id:
+                events.append(event)
+        return events
+
+    def streaming_response(self, request, topic=None, policy=None, topics=None):
         """Generate a streaming HTTP responses with server-sent events.
 
         See https://html.spec.whatwg.org/multipage/server-sent-events.html
@@ -825,10 +2749,15 @@ class PubSub:
         When reconnecting after loosing the connection for a while, browsers
         automatically set the `Last-Event-ID` header field to the value of
         the id of the last received event. The response will first replay
-        missed events, before sending newly arriving events. When the event
-        specified by `Last-Event-ID` is not found, a 404 Not Found response
-        is sent, signalling to the browser, that a clean recovery is not
-        possible.
+        missed events, before sending newly arriving events. When the events
+        after `Last-Event-ID` are not all known anymore, a 404 Not Found
+        response is sent, signalling to the browser, that a clean recovery is
+        not possible.
+
+        Like with `subscribe`, a `topic` or a list of `topics` can be given.
+
+        Without events, a comment is sent every `heartbeat` seconds (see
+        `PubSub`), so that proxies do not close the connection.
 
         Here is an example session. First, let us create an API:
         >>> api = API()
@@ -859,6 +2788,11 @@ class PubSub:
         >>> code
         '200 OK'
 
+        The stream starts with a comment, so that the browser gets the
+        response headers without waiting for the next event:
+        >>> next(body)
+        b': connected\\n\\n'
+
         The events are formated according to the specification for server-sent
         events:
         >>> print(str(next(body), encoding="utf-8").strip())
@@ -873,16 +2807,435 @@ class PubSub:
         id: 2
         event: message
         data: "howdoyoudo?"
+
+        The stream is subscribed before the missed events are looked up, so
+        events published before the server starts sending it are not lost
+        either, and replayed events are not sent twice:
+        >>> body, code, *_ = client.get("/", headers={"Last-Event-ID": "1"})
+        >>> resp = client.post("/", json={"message": "meanwhile"})
+        >>> [next(body).split(b"\\n")[0] for _ in range(3)]
+        [b': connected', b'id: 2', b'id: 3']
         """
+        topics = _topic_list(topic, topics)
         last_id = request.headers.get("Last-Event-ID", None)
+        # Subscribed before the replay is taken, so that no event published
+        # in between is missed
+        subscriber = self._new_subscriber(policy)
+        targets = self._add_subscriber(topics, subscriber)
         try:
-            replay_events = self._replay_events(last_id)
+            replay_events = self._replay_events(last_id, topics)
         except ValueError:
+            self._remove_subscriber(targets, subscriber)
             raise NotFound()
 
-        return werkzeug.Response(
-            self._event_stream(replay_events, topic), mimetype="text/event-stream"
+        subscription = self._receive(subscriber, targets, self.heartbeat)
+        response = werkzeug.Response(
+            self._event_stream(subscription, replay_events), mimetype="text/event-stream"
         )
+        # Also unsubscribes when the stream is closed before it is read
+        response.call_on_close(functools.partial(self._remove_subscriber, targets, subscriber))
+        return response
+
+
+def _broker_socket(address):
+    # Paths are Unix domain sockets, (host, port) tuples TCP sockets
+    if isinstance(address, str):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+
+class PubSubBroker:
+    """Relay of events between `PubSub` instances in several processes.
+
+    Every `PubSub(broker=address)` sends its events to the broker, which
+    numbers them and sends them to all connected instances, in the same
+    order. All processes therefore share the event ids, and a client can
+    resume with its `Last-Event-ID` from whichever process it reconnects
+    to. With a `replay_dir`, the broker keeps the events on disk (for at
+    most `replay_max_age` seconds, see `_DurableLog`) and the ids continue
+    after a restart.
+
+    The `address` is the path of a Unix domain socket, or a (host, port)
+    tuple for TCP. The broker runs in a background thread of the process
+    that starts it:
+    >>> import os, subprocess, tempfile
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> address = os.path.join(directory.name, "pubsub.sock")
+    >>> broker = PubSubBroker(address).start()
+
+    Now let us start some worker processes, which each publish one
+    message, once all of them are listening:
+    >>> worker = '''
+    ... import sys, api_utils
+    ... chat = api_utils.PubSub(broker=sys.argv[1])
+    ... subscription = chat.subscribe()
+    ... print("ready", flush=True)
+    ... sys.stdin.readline()
+    ... chat.publish("message", sys.argv[2])
+    ... events = [next(subscription) for _ in range(3)]
+    ... print(sorted(event.data for event in events), [event.id for event in events])
+    ... '''
+    >>> workers = [
+    ...     subprocess.Popen(
+    ...         [sys.executable, "-c", worker, address, name],
+    ...         cwd=os.path.dirname(os.path.abspath(__file__)),
+    ...         stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+    ...     )
+    ...     for name in ("Ann", "Bob", "Eve")
+    ... ]
+    >>> [worker.stdout.readline() for worker in workers]
+    ['ready\\n', 'ready\\n', 'ready\\n']
+    >>> for worker in workers:
+    ...     worker.stdin.write("go\\n")
+    ...     worker.stdin.flush()
+    ...
+    3
+    3
+    3
+
+    Every worker received every message, with the same ids:
+    >>> outputs = [worker.communicate(timeout=30)[0] for worker in workers]
+    >>> print(outputs[0], end="")
+    ['Ann', 'Bob', 'Eve'] [0, 1, 2]
+    >>> outputs[0] == outputs[1] == outputs[2]
+    True
+    >>> broker.close()
+    >>> directory.cleanup()
+    """
+
+    def __init__(self, address, replay_dir=None, queue_size=10_000, replay_max_age=None):
+        self._socket = _broker_socket(address)
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+        else:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(address)
+        self._socket.listen()
+        self.address = self._socket.getsockname()
+        self.queue_size = queue_size
+
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._durable_log = None
+        self._current_id = itertools.count()
+        if replay_dir is not None:
+            self._durable_log = _DurableLog(replay_dir, max_age=replay_max_age)
+            self._current_id = itertools.count(self._durable_log.next_id)
+
+    def start(self):
+        """Serve in a background thread, returns the broker."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:  # Closed
+                return
+            outbox = queue.Queue(self.queue_size)
+            # Tells the process that it receives all events from now on
+            outbox.put_nowait(b"[]\n")
+            with self._lock:
+                self._clients[connection] = outbox
+            threading.Thread(target=self._receive, args=(connection,), daemon=True).start()
+            threading.Thread(
+                target=self._send, args=(connection, outbox), daemon=True
+            ).start()
+
+    def _receive(self, connection):
+        try:
+            for record in connection.makefile("rb"):
+                record = record.rstrip(b"\n")
+                try:
+                    topics, *rest = json_codec.loads(record)
+                    # [topics, event_type, data], or with a reset flag
+                    valid = isinstance(topics, list) and len(rest) in (2, 3)
+                except (ValueError, TypeError):
+                    valid = False
+                if not valid:
+                    raise ValueError(f"Invalid event: {record[:100]}")
+                self._publish(record, reset=len(rest) == 3 and rest[2] is True)
+        except (OSError, ValueError) as e:
+            print(f"PubSubBroker: {e}", file=sys.stderr)
+        finally:
+            self._disconnect(connection)
+
+    def _publish(self, record, reset=False):
+        stalled = []
+        with self._lock:
+            id = next(self._current_id)
+            if self._durable_log is not None:
+                if reset:
+                    self._durable_log.reset(id)
+                self._durable_log.append_record(id, record)
+            # Prepend the id to the JSON array [topics, event_type, data]
+            line = b"[%d," % id + record[1:] + b"\n"
+            for connection, outbox in self._clients.items():
+                try:
+                    outbox.put_nowait(line)
+                except queue.Full:  # A process stopped reading
+                    stalled.append(connection)
+        for connection in stalled:
+            self._disconnect(connection)
+
+    def _send(self, connection, outbox):
+        try:
+            while True:
+                line = outbox.get()
+                if line is None:
+                    return
+                connection.sendall(line)
+        except OSError:
+            self._disconnect(connection)
+
+    def _disconnect(self, connection):
+        with self._lock:
+            outbox = self._clients.pop(connection, None)
+        if outbox is not None:
+            try:
+                outbox.put_nowait(None)
+            except queue.Full:
+                pass
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+
+    def close(self):
+        self._socket.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+        for connection in list(self._clients):
+            self._disconnect(connection)
+        if self._durable_log is not None:
+            self._durable_log.close()
+
+
+class _BrokerConnection:
+    """Connection of a `PubSub` to a `PubSubBroker`.
+
+    Events from the broker are passed to `dispatch` in a background thread.
+    When the connection is lost, `disconnected` is called, and the
+    connection is re-established every `retry` seconds. Events published in
+    the meantime are missed.
+    """
+
+    def __init__(self, address, dispatch, disconnected, retry=0.5, timeout=5):
+        self.address = address
+        self.dispatch = dispatch
+        self.disconnected = disconnected
+        self.retry = retry
+        self.timeout = timeout
+        self._send_lock = threading.Lock()
+        self._closed = False
+        self._socket, reader = self._connect()
+        threading.Thread(target=self._receive, args=(reader,), daemon=True).start()
+
+    def _connect(self):
+        # Returns once the broker sends events to the connection, so that
+        # none published afterwards are missed
+        sock = _broker_socket(self.address)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+            reader = sock.makefile("rb")
+            if reader.readline() != b"[]\n":
+                raise ConnectionError("No PubSub broker at this address")
+            sock.settimeout(None)
+        except OSError:
+            sock.close()
+            raise
+        return sock, reader
+
+    def send(self, topics, event_type, data, reset=False):
+        record = [topics, event_type, data, True] if reset else [topics, event_type, data]
+        line = json_codec.dumps(record, compact=True) + b"\n"
+        with self._send_lock:
+            if self._socket is None:
+                raise ConnectionError("Not connected to the PubSub broker")
+            self._socket.sendall(line)
+
+    def _receive(self, reader):
+        while not self._closed:
+            try:
+                for line in reader:
+                    id, topics, event_type, data, *reset = json_codec.loads(line)
+                    # Topics must stay hashable
+                    topics = [_hashable_topic(topic) for topic in topics]
+                    self.dispatch(Event(id, event_type, data), topics, reset=reset == [True])
+            except OSError:
+                pass
+            with self._send_lock:
+                self._socket = None
+            if not self._closed:
+                self.disconnected()
+            while not self._closed:
+                time.sleep(self.retry)
+                try:
+                    sock, reader = self._connect()
+                except OSError:
+                    continue
+                with self._send_lock:
+                    self._socket = sock
+                break
+
+    def close(self):
+        self._closed = True
+        with self._send_lock:
+            if self._socket is not None:
+                try:
+                    self._socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self._socket.close()
+                self._socket = None
+
+
+class _AsyncSubscriber(_Subscriber):
+    """Subscriber read in an event loop."""
+
+    def __init__(self, loop, maxsize=100, policy="disconnect"):
+        super().__init__(maxsize, policy)
+        self.loop = loop
+        self.waiter = None
+
+    def wake(self, value=True):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(value)
+
+    def close(self):
+        """End the subscription after the queued events, from any thread."""
+        self.closed = True
+        try:
+            self.loop.call_soon_threadsafe(self.wake)
+        except RuntimeError:  # The event loop is closed
+            pass
+
+    async def wait(self, timeout=None):
+        """Wait for events, return False after `timeout` seconds."""
+        self.waiter = self.loop.create_future()
+        timer = None
+        if timeout is not None:
+            timer = self.loop.call_later(timeout, self.wake, False)
+        try:
+            return await self.waiter
+        finally:
+            self.waiter = None
+            if timer is not None:
+                timer.cancel()
+
+
+class AsyncPubSub(PubSub):
+    """Publish/subscribe for asyncio, see `PubSub`.
+
+    Subscriptions are async iterators waiting on a future, so an idle
+    subscriber only costs a little memory instead of a thread. Events can
+    be published from any thread, e.g. from synchronous handlers running in
+    the executor of `AsyncAPI`.
+
+    >>> chat = AsyncPubSub()
+    >>> async def main():
+    ...     subscription = chat.subscribe()
+    ...     chat.publish("message", "Hello")
+    ...     print(await subscription.__anext__())
+    ...     await subscription.aclose()
+    ...
+    >>> asyncio.run(main())
+    Event(id=0, event_type='message', data='Hello')
+
+    `streaming_response` returns a stream for `AsyncAPI`, it cannot be
+    served by a WSGI server. Like `subscribe`, it must be called within the
+    running event loop, i.e. from a coroutine handler.
+    """
+
+    def _fan_out(self, queues, event, delivered):
+        # Called from any thread: wake up every event loop once, instead of
+        # once per subscriber. Drops are counted by _deliver.
+        loops = collections.defaultdict(list)
+        for subscriber in queues:
+            if subscriber in delivered:
+                continue
+            delivered.add(subscriber)
+            loops[subscriber.loop].append(subscriber)
+        for loop, subscribers in loops.items():
+            try:
+                loop.call_soon_threadsafe(self._deliver, subscribers, event)
+            except RuntimeError:  # The event loop is closed
+                queues.difference_update(subscribers)
+        return 0, 0
+
+    def _deliver(self, subscribers, event):
+        dropped = disconnected = 0
+        for subscriber in subscribers:
+            if subscriber.closed:
+                continue
+            try:
+                dropped += subscriber._offer(event)
+            except queue.Full:
+                # The subscriber unsubscribes itself when woken up
+                disconnected += 1
+            subscriber.wake()
+        if dropped or disconnected:
+            with self._stats_lock:
+                self._stats["dropped"] += dropped
+                self._stats["disconnected"] += disconnected
+
+    def subscribe(self, topic=None, policy=None, topics=None):
+        """Subscribe to published events, see `PubSub.subscribe`.
+
+        Must be called within the running event loop, returns an async
+        iterator.
+        """
+        events = self._subscribe(_topic_list(topic, topics), policy)
+
+        async def iterator():
+            try:
+                async for event in events:
+                    if event is not None:
+                        yield event
+            finally:
+                await events.aclose()
+
+        return iterator()
+
+    def _subscribe(self, topics=(None,), policy=None, timeout=None):
+        subscriber = self._new_subscriber(policy)
+        targets = self._add_subscriber(topics, subscriber)
+        return self._receive(subscriber, targets, timeout)
+
+    def _new_subscriber(self, policy=None):
+        return _AsyncSubscriber(asyncio.get_running_loop(), self.queue_size, policy or self.policy)
+
+    async def _receive(self, subscriber, targets, timeout):
+        # Yields None after `timeout` seconds without events
+        try:
+            while True:
+                if subscriber.events:
+                    yield subscriber.events.popleft()
+                    continue
+                elif subscriber.closed:
+                    return
+                if not await subscriber.wait(timeout):
+                    yield None
+        finally:
+            self._remove_subscriber(targets, subscriber)
+
+    async def _event_stream(self, subscription, replay_events=()):
+        try:
+            yield b": connected\n\n"
+            for event in replay_events:
+                yield event.frame
+            replayed = _replayed_ids(replay_events)
+            async for event in subscription:
+                if event is None:
+                    yield b": heartbeat\n\n"
+                elif event.id not in replayed:
+                    yield event.frame
+        finally:
+            await subscription.aclose()
 
 
 __all__ = (
@@ -890,10 +3243,17 @@ __all__ = (
     "NotFound",
     "Unauthorized",
     "UnprocessableEntity",
+    "ServiceUnavailable",
     "timestamp",
     "ExternalAuth",
     "DummyAuth",
     "run",
+    "Compress",
     "UsernamePasswordAuth",
     "PubSub",
+    "PubSubBroker",
+    "AsyncAPI",
+    "AsyncPubSub",
+    "JSONCodec",
+    "json_codec",
 )
@@ -0,0 +1,82 @@
+"""Benchmark of concurrent logins with `UsernamePasswordAuth`.
+
+Simulates a login burst (e.g. after a restart): many clients log in at
+the same time, with a `find_password` that waits like a database query.
+Reports the login throughput, the latency of successful logins, and the
+number of logins rejected with 503 Service Unavailable, for a few sizes
+of the hashing queue.
+
+Run from the repository root:
+
+    python -m benchmarks.login
+"""
+
+import crypt
+import statistics
+import threading
+import time
+
+from werkzeug.test import Client
+
+import api_utils
+
+PASSWORDS = {f"user{n}": crypt.crypt(f"password{n}") for n in range(50)}
+
+
+def find_password(username, query_time=0.002):
+    time.sleep(query_time)
+    return PASSWORDS.get(username)
+
+
+def burst(app, clients, logins):
+    codes = []
+    latencies = []
+    lock = threading.Lock()
+
+    def client(n):
+        http = Client(app)
+        for i in range(logins):
+            user = (n + i) % len(PASSWORDS)
+            cred = {"username": f"user{user}", "password": f"password{user}"}
+            start = time.perf_counter()
+            body, code, _ = http.post("/auth/login", json=cred)
+            b"".join(body)
+            latency = time.perf_counter() - start
+            with lock:
+                codes.append(code[:3])
+                if code.startswith("200"):
+                    latencies.append(latency)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, codes, latencies
+
+
+def main(clients=64, logins=10, queue_sizes=(0, 16, 64)):
+    results = {}
+    for hash_queue_size in queue_sizes:
+        app = api_utils.UsernamePasswordAuth(
+            api_utils.API(),
+            "not a secret",
+            find_password=find_password,
+            hash_queue_size=hash_queue_size,
+        )
+        elapsed, codes, latencies = burst(app, clients, logins)
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0.0
+        results[hash_queue_size] = (elapsed, codes.count("200"), codes.count("503"))
+        print(
+            f"hash_queue_size={hash_queue_size}: {len(codes)} logins from {clients} "
+            f"threads in {elapsed * 1e3:.0f} ms, {codes.count('200') / elapsed:.0f} "
+            f"successful/s, {codes.count('503')} rejected, latency median "
+            f"{statistics.median(latencies or [0]) * 1e3:.1f} ms, p99 {p99 * 1e3:.1f} ms"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    main()
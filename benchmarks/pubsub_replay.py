@@ -0,0 +1,85 @@
+"""Benchmark of `PubSub` replays for reconnecting event streams.
+
+Simulates a reconnect storm (e.g. after a deploy): 1000 clients look up
+their `Last-Event-ID` in a full replay log, spread evenly over its
+length, while a publisher keeps publishing. Reports the time for all
+reconnects and the publish latency during the storm.
+
+Run from the repository root:
+
+    python -m benchmarks.pubsub_replay
+"""
+
+import random
+import statistics
+import threading
+import time
+
+import api_utils
+
+
+def reconnect(chat, last_ids):
+    for last_id in last_ids:
+        try:
+            chat._replay_events(last_id)
+        except ValueError:  # Trimmed from the log by the publisher meanwhile
+            pass
+
+
+def main(clients=1000, threads=8, log_size=1000):
+    chat = api_utils.PubSub()
+    for i in range(log_size):
+        chat.publish("message", {"content": "x" * 64, "n": i})
+
+    last_ids = [str(i) for i in range(0, log_size, log_size // clients or 1)][:clients]
+    random.Random(0).shuffle(last_ids)
+
+    # Reconnects only
+    start = time.perf_counter()
+    reconnect(chat, last_ids)
+    sequential = time.perf_counter() - start
+    print(f"{len(last_ids)} reconnects: {sequential * 1e3:.1f} ms")
+
+    # Reconnects from several threads, while events are published
+    stop = threading.Event()
+    latencies = []
+
+    def publisher():
+        while not stop.is_set():
+            start = time.perf_counter()
+            chat.publish("message", {"content": "y" * 64})
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.0001)
+
+    publishing = threading.Thread(target=publisher)
+    publishing.start()
+    time.sleep(0.05)
+    # The ids are sequential: reconnect to the newer half of the log, which
+    # stays in the log while the publisher appends to it
+    newest = log_size - 1 + len(latencies)
+    storm_ids = [str(newest - int(last_id) % (log_size // 2)) for last_id in last_ids]
+    workers = [
+        threading.Thread(target=reconnect, args=(chat, storm_ids[n::threads]))
+        for n in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    storm = time.perf_counter() - start
+    stop.set()
+    publishing.join()
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(
+        f"{len(last_ids)} reconnects in {threads} threads while publishing: "
+        f"{storm * 1e3:.1f} ms, publish latency median "
+        f"{statistics.median(latencies) * 1e6:.1f} us, p99 {p99 * 1e6:.1f} us"
+    )
+    return sequential, storm, p99
+
+
+if __name__ == "__main__":
+    main()
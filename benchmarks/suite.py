@@ -0,0 +1,513 @@
+"""Benchmark suite for the hot paths of the server.
+
+Runs the application of server.py in-process against `werkzeug.test.Client`
+and over a real socket, with the production server of `api_utils.run`
+started in a subprocess. Covers:
+
+ - POST /api/ throughput versus the size of the message history,
+ - GET /api/ latency versus the number of messages,
+ - `PubSub` and `AsyncPubSub` fan-out latency at N subscribers, and over
+   server-sent event streams,
+ - `_parse_json_body` cost (see `benchmarks.parse_json_body`),
+ - JWT middleware overhead.
+
+Progress is printed to stderr, the results are written as JSON to stdout or
+to the file given with `--output`, so that they can be compared between
+releases. Every result is a flat object with the name of the benchmark, its
+parameters and its measurements (times in milliseconds or microseconds, as
+noted in the key).
+
+Run from the repository root:
+
+    python -m benchmarks.suite [--quick] [--output results.json]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import http.client
+import importlib.metadata
+import json
+import logging
+import os
+import platform
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+import werkzeug
+import werkzeug.test
+from werkzeug.test import Client
+
+import api_utils
+from benchmarks import parse_json_body
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+USERS = {"?": "Alle", **{f"user{n}": f"User {n}" for n in range(20)}}
+
+SIZES = {
+    "full": {
+        "history": (0, 10_000, 100_000),
+        "requests": 2_000,
+        "threads": 8,
+        "subscribers": (10, 100, 1_000),
+        "async_subscribers": (100, 1_000, 10_000),
+        "streams": (10, 50),
+        "publishes": 20,
+    },
+    "quick": {
+        "history": (0, 10_000),
+        "requests": 400,
+        "threads": 4,
+        "subscribers": (10, 100),
+        "async_subscribers": (100, 1_000),
+        "streams": (10,),
+        "publishes": 5,
+    },
+}
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def latency_stats(latencies):
+    latencies = sorted(latencies)
+    return {
+        "latency_median_ms": statistics.median(latencies) * 1e3,
+        "latency_p99_ms": latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1e3,
+    }
+
+
+def message(n):
+    sender = f"user{n % 20}"
+    return {
+        "type": "message",
+        "fromUser": sender,
+        "toUser": "?" if n % 5 == 0 else f"user{(n + 1) % 20}",
+        "content": f"Message {n} " + "x" * 48,
+    }
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def run_server_main(argv, run):
+    """Call server.main() with the command line `argv`, and `run` in place
+    of `api_utils.run`. Returns the return value of `run`.
+    """
+    result = []
+    original_argv, original_run = sys.argv, api_utils.run
+    sys.argv = ["server.py", *argv]
+    api_utils.run = lambda app, **kwargs: result.append(run(app, **kwargs))
+    try:
+        # server.py prints a warning to stdout when imported
+        with contextlib.redirect_stdout(sys.stderr):
+            import server
+
+            server.main()
+    finally:
+        sys.argv, api_utils.run = original_argv, original_run
+    return result[0] if result else None
+
+
+def prepare(directory, storage, history):
+    """Write `history` messages in the format of `storage.Store`."""
+    with open(os.path.join(directory, "users.json"), "w") as f:
+        json.dump(USERS, f)
+    with open(os.path.join(directory, "data.jsonl"), "w") as f:
+        for n in range(history):
+            entry = message(n)
+            entry["from"] = entry.pop("fromUser")
+            entry["to"] = entry.pop("toUser")
+            entry["id"] = n + 1
+            entry["time"] = int(time.time())
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+    if storage == "sqlite":
+        with working_directory(directory):
+            run_server_main(["--migrate"], None)
+
+
+def in_process(directory, storage, body):
+    """Run `body(connect)` against the app of server.py, in-process."""
+
+    def run(app, **kwargs):
+        def connect():
+            client = Client(app, response_wrapper=werkzeug.Response)
+
+            def request(method, path, body=None):
+                response = client.open(
+                    path, method=method, data=body, content_type="application/json"
+                )
+                response.get_data()
+                return response.status_code
+
+            return request
+
+        return body(connect)
+
+    with working_directory(directory):
+        return run_server_main(["--storage", storage], run)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def over_socket(directory, storage, body):
+    """Run `body(connect)` against server.py, served by `api_utils.run` in a
+    subprocess.
+    """
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    command = [sys.executable, "-m", "benchmarks.suite", "--serve", str(port), "--storage", storage]
+    process = subprocess.Popen(command, cwd=directory, env=env, stdout=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError("The server did not start")
+                time.sleep(0.05)
+
+        def connect():
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+
+            def request(method, path, body=None):
+                connection.request(method, path, body, {"Content-Type": "application/json"})
+                response = connection.getresponse()
+                response.read()
+                return response.status
+
+            request.port = port
+            return request
+
+        return body(connect)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(30)
+
+
+def serve(port, storage):
+    """Run server.py on `port`, for `over_socket`."""
+    # Request logs would dominate the measurements
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    run = api_utils.run
+    run_server_main(["--storage", storage], lambda app, **kwargs: run(app, **{**kwargs, "port": port}))
+
+
+def in_threads(connect, threads, count, task):
+    """Call `task(request, n)` `count` times from `threads` threads, returns
+    the elapsed time and the latencies.
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(numbers):
+        request = connect()
+        own = []
+        for n in numbers:
+            start = time.perf_counter()
+            task(request, n)
+            own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+
+    workers = [
+        threading.Thread(target=worker, args=(range(i, count, threads),)) for i in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    return time.perf_counter() - start, latencies
+
+
+def post_throughput(connect, threads, count):
+    def post(request, n):
+        status = request("POST", "/api/", json.dumps(message(n)))
+        assert status == 200, status
+
+    elapsed, latencies = in_threads(connect, threads, count, post)
+    return {"requests": count, "threads": threads, "requests_per_s": count / elapsed, **latency_stats(latencies)}
+
+
+def get_latency(connect, count):
+    request = connect()
+    results = {}
+    for name, path in (
+        ("all", "/api/"),
+        ("user", "/api/?user=user1"),
+        ("since", "/api/?since=999999999&user=user1"),
+    ):
+        latencies = []
+        for _ in range(max(count // 10, 10)):
+            start = time.perf_counter()
+            status = request("GET", path)
+            latencies.append(time.perf_counter() - start)
+            assert status == 200, status
+        results[name] = latency_stats(latencies)
+    return results
+
+
+def pubsub_fan_out(subscribers, publishes):
+    """Latency from `publish` until every thread subscriber got the event."""
+    chat = api_utils.PubSub(queue_size=publishes + 1)
+    received = threading.Semaphore(0)
+    ready = threading.Barrier(subscribers + 1)
+
+    def subscriber():
+        subscription = chat.subscribe()
+        ready.wait()
+        for _ in range(publishes):
+            next(subscription)
+            received.release()
+        subscription.close()
+
+    threads = [threading.Thread(target=subscriber, daemon=True) for _ in range(subscribers)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    latencies = []
+    for n in range(publishes):
+        start = time.perf_counter()
+        chat.publish("message", n)
+        for _ in range(subscribers):
+            received.acquire()
+        latencies.append(time.perf_counter() - start)
+    for thread in threads:
+        thread.join()
+    return latency_stats(latencies)
+
+
+def async_pubsub_fan_out(subscribers, publishes):
+    """Latency from `publish` until every `AsyncPubSub` subscriber got the event."""
+
+    async def main():
+        chat = api_utils.AsyncPubSub(queue_size=publishes + 1)
+        counter = {"remaining": 0}
+        done = asyncio.Event()
+
+        async def subscriber(subscription):
+            async for _ in subscription:
+                counter["remaining"] -= 1
+                if counter["remaining"] == 0:
+                    done.set()
+
+        subscriptions = [chat.subscribe() for _ in range(subscribers)]
+        tasks = [asyncio.create_task(subscriber(s)) for s in subscriptions]
+        await asyncio.sleep(0)
+        latencies = []
+        for n in range(publishes):
+            counter["remaining"] = subscribers
+            done.clear()
+            start = time.perf_counter()
+            chat.publish("message", n)
+            await done.wait()
+            latencies.append(time.perf_counter() - start)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return latency_stats(latencies)
+
+    return asyncio.run(main())
+
+
+def stream_fan_out(connect, streams, publishes):
+    """Latency from POST /api/ until every event stream got the message."""
+    port = connect().port
+    received = threading.Semaphore(0)
+    ready = threading.Barrier(streams + 1)
+
+    def stream(n):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        connection.request("GET", f"/api/stream/?user=user{n % 20}")
+        response = connection.getresponse()
+        ready.wait()
+        events = 0
+        while events < publishes:
+            if response.fp.readline().startswith(b"event: message"):
+                events += 1
+                received.release()
+        connection.close()
+
+    threads = [threading.Thread(target=stream, args=(n,), daemon=True) for n in range(streams)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    time.sleep(0.1)  # The responses are sent before the subscriptions exist
+    request = connect()
+    latencies = []
+    for n in range(publishes):
+        start = time.perf_counter()
+        request("POST", "/api/", json.dumps({**message(n), "toUser": "?"}))
+        for _ in range(streams):
+            received.acquire()
+        latencies.append(time.perf_counter() - start)
+    for thread in threads:
+        thread.join()
+    return latency_stats(latencies)
+
+
+def jwt_overhead(count, repeat=5):
+    """Time per WSGI call without and with `DummyAuth` (best of `repeat`).
+
+    The app is called directly, without a test client, whose own overhead
+    would hide the difference.
+    """
+    api = api_utils.API()
+
+    @api.GET("/")
+    def root(request):
+        return "ok"
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    results = {}
+    for name, app, cache_size in (
+        ("without_auth", api, None),
+        ("cached_token", api_utils.DummyAuth(api, "benchmark secret" * 2), 1_000),
+        ("uncached_token", api_utils.DummyAuth(api, "benchmark secret" * 2, token_cache_size=0), 0),
+    ):
+        headers = {}
+        if cache_size is not None:
+            client = Client(app, response_wrapper=werkzeug.Response)
+            token = json.loads(client.post("/auth/login").get_data())["token"]
+            headers = {"Authorization": f"Bearer {token}"}
+        environ = werkzeug.test.EnvironBuilder("/", headers=headers).get_environ()
+
+        def call():
+            b"".join(app(dict(environ), start_response))
+
+        results[name] = min(timeit.repeat(call, number=count, repeat=repeat)) / count * 1e6
+    return {
+        "request_us": results,
+        "overhead_cached_us": results["cached_token"] - results["without_auth"],
+        "overhead_uncached_us": results["uncached_token"] - results["without_auth"],
+    }
+
+
+def metadata(size):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit or None,
+        "size": size,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "werkzeug": importlib.metadata.version("werkzeug"),
+        "json_codec": api_utils.json_codec.name,
+    }
+
+
+def main(size="full", storages=("json", "sqlite"), modes=("in-process", "socket")):
+    sizes = SIZES[size]
+    results = []
+
+    def record(name, **values):
+        results.append({"benchmark": name, **values})
+        log(json.dumps(results[-1]))
+
+    runners = {"in-process": in_process, "socket": over_socket}
+    for mode in modes:
+        for storage in storages:
+            for history in sizes["history"]:
+                with tempfile.TemporaryDirectory() as directory:
+                    prepare(directory, storage, history)
+                    measured = runners[mode](
+                        directory,
+                        storage,
+                        lambda connect: (
+                            get_latency(connect, sizes["requests"]),
+                            post_throughput(connect, sizes["threads"], sizes["requests"]),
+                        ),
+                    )
+                get, post = measured
+                for query, stats in get.items():
+                    record("get", mode=mode, storage=storage, messages=history, query=query, **stats)
+                record("post", mode=mode, storage=storage, history=history, **post)
+
+    for subscribers in sizes["subscribers"]:
+        record("pubsub_fan_out", mode="in-process", subscribers=subscribers,
+               **pubsub_fan_out(subscribers, sizes["publishes"]))
+    for subscribers in sizes["async_subscribers"]:
+        record("async_pubsub_fan_out", mode="in-process", subscribers=subscribers,
+               **async_pubsub_fan_out(subscribers, sizes["publishes"]))
+    if "socket" in modes:
+        for streams in sizes["streams"]:
+            with tempfile.TemporaryDirectory() as directory:
+                prepare(directory, "json", 0)
+                stats = over_socket(
+                    directory,
+                    "json",
+                    lambda connect: stream_fan_out(connect, streams, sizes["publishes"]),
+                )
+            record("stream_fan_out", mode="socket", streams=streams, **stats)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        timings = parse_json_body.main(number=sizes["requests"] * 10, repeat=3)
+    record(
+        "parse_json_body",
+        mode="in-process",
+        request_us=timings["compiled plan"] * 1e6,
+        baseline_request_us=timings["per-call validation"] * 1e6,
+    )
+    record("jwt_overhead", mode="in-process", **jwt_overhead(sizes["requests"]))
+
+    return {"metadata": metadata(size), "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="smaller sizes, for a quick check")
+    parser.add_argument("--output", help="file for the JSON results (default: stdout)")
+    parser.add_argument("--storage", action="append", choices=("json", "sqlite"),
+                        help="storage backends to measure (default: both)")
+    parser.add_argument("--mode", action="append", choices=("in-process", "socket"),
+                        help="how to reach the server (default: both)")
+    parser.add_argument("--serve", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, (args.storage or ["json"])[0])
+        sys.exit()
+
+    report = main(
+        "quick" if args.quick else "full",
+        tuple(args.storage or ("json", "sqlite")),
+        tuple(args.mode or ("in-process", "socket")),
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -2,9 +2,10 @@
 # | Published under the GNU GENERAL PUBLIC LICENSE. Copyright © 2021 Mattia Metzler. |
 # | ================================================================================ |
 
-import json
 import api_utils
-import os
+import argparse
+import storage
+import threading
 from uuid import uuid4
 
 def main():
@@ -12,56 +13,166 @@ def main():
     Diese Funktion stellt den Server hinter der Web-App dar. Dafür wird durch die Datei api_utils.py ein Webserver gestartet.\n
     Der Webserver nimmt requests (GET, POST, DELETE) vom Client entgegen und antwortet mit responses. Diese responses können anschliessend auf dem Client verwendet werden.\n
     """
-    api = api_utils.API()
+    # Kommandozeile: "python server.py --storage sqlite" speichert alles in der Datenbank "data.db" statt in JSON-Dateien,
+    # "python server.py --migrate" übernimmt die Nachrichten und Benutzer aus den JSON-Dateien in die Datenbank
+    parser = argparse.ArgumentParser(description="Server der Web-App")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json", help="Speicherort der Nachrichten und Benutzer (Standard: json)")
+    parser.add_argument("--migrate", action="store_true", help="data.jsonl bzw. data.json und users.json in data.db übernehmen und beenden")
+    args = parser.parse_args()
+
+    api = api_utils.API(compact=True) # JSON ohne Einrückung, damit weniger Daten übertragen werden
 
     # Dateien für Nachrichten und Benutzer
-    filename = "data.json"
+    filename = "data.jsonl"
     filenameUsers = "users.json"
+    filenameDatabase = "data.db"
+    # Änderungen werden von einem einzigen Thread gespeichert: nach der ersten Änderung sammelt er während flushInterval Sekunden weitere Änderungen
+    # und speichert sie gemeinsam mit einem einzigen Schreibvorgang (group commit), so braucht nicht jede Nachricht ein eigenes fsync
+    # auch ohne zu warten sammeln sich während einem Schreibvorgang die nächsten Änderungen, darum wird hier nicht zusätzlich gewartet
+    flushInterval = 0.0
+    maxBatchSize = 1000 # höchstens so viele Nachrichten pro Schreibvorgang
+    saveTimeout = 10.0 # Sekunden, welche ein request höchstens auf das Speichern wartet
+
+    # Aufbewahrung der Nachrichten, None bedeutet unbegrenzt
+    maxAge = None # Sekunden, z.B. 30 * 24 * 3600 für 30 Tage
+    maxMessagesPerConversation = None # Anzahl Nachrichten pro Gespräch
+    keyExchangeTtl = 7 * 24 * 3600 # Schlüsselaustausche sind nach einer Woche längst abgeschlossen, die Schlüssel liegen im Browser
+    compactInterval = 60.0 # Sekunden zwischen dem Entfernen alter Nachrichten
+
+    if args.migrate:
+        # die JSON-Dateien werden dabei nicht verändert
+        database = storage.SqliteStore(filenameDatabase)
+        messages, lastId, clearedId, users = storage.readJsonFiles(filename, filenameUsers, legacyFilename="data.json")
+        database.importData(messages, lastId, clearedId, users)
+        database.close()
+        print(f"{len(messages)} Nachrichten und {len(users)} Benutzer wurden in {filenameDatabase} übernommen.")
+        return
+
+    if args.storage == "sqlite":
+        # Nachrichten und Benutzer werden in der Datenbank gespeichert, die Abfragen verwenden Indexe pro Benutzer
+        store = storage.SqliteStore(filenameDatabase, maxAge=maxAge, maxMessagesPerConversation=maxMessagesPerConversation,
+                                    keyExchangeTtl=keyExchangeTtl, compactInterval=compactInterval, fsync=True)
+    else:
+        # Nachrichten und Benutzer werden im Arbeitsspeicher gehalten und im Hintergrund gespeichert, eine bestehende "data.json" wird dabei übernommen
+        store = storage.Store(filename, filenameUsers, legacyFilename="data.json", flushInterval=flushInterval,
+                              maxAge=maxAge, maxMessagesPerConversation=maxMessagesPerConversation, keyExchangeTtl=keyExchangeTtl, compactInterval=compactInterval,
+                              maxBatchSize=maxBatchSize, fsync=True)
+
+    # der Client bekommt erst eine Antwort, wenn seine Änderung wirklich gespeichert ist
+    def waitUntilSaved():
+        if not store.waitUntilSaved(saveTimeout):
+            raise api_utils.ServiceUnavailable("Die Änderung konnte nicht gespeichert werden.")
+
+    # Neue Nachrichten, Schlüsselaustausche und Benutzer werden als server-sent events an die Clients geschickt
+    # Die events werden im Ordner "events" gespeichert, damit Clients auch nach einem Neustart des Servers dort weitermachen können, wo sie waren
+    # sie enthalten Nachrichten und Schlüsselaustausche, darum werden sie nicht länger aufbewahrt als diese
+    replayMaxAge = min((age for age in (maxAge, keyExchangeTtl) if age is not None), default=None)
+    chat = api_utils.PubSub(replay_dir="events", replay_max_age=replayMaxAge)
+
+    # Änderungen werden erst an die Clients geschickt, wenn sie gespeichert sind, sonst sähen Clients Nachrichten, welche danach verloren gehen
+    # Nachrichten werden trotzdem in der Reihenfolge ihrer id veröffentlicht, damit Clients keine Nachricht verpassen: jede Änderung erhält
+    # zusammen mit ihrer id eine fortlaufende Nummer (ticket), und wird erst veröffentlicht, wenn alle Änderungen davor veröffentlicht sind
+    publishLock = threading.Condition()
+    nextTicket = 0
+    publishedTickets = 0
 
-    # Dateien vorbereiten falls sie noch nicht existieren
-    if not os.path.exists(filename):
-        with open(filename, "w") as f:
-            json.dump([], f)
+    def takeTicket():
+        # muss mit gesperrtem publishLock aufgerufen werden, nachdem die Änderung erfolgreich war
+        nonlocal nextTicket
+        ticket = nextTicket
+        nextTicket += 1
+        return ticket
 
-    if not os.path.exists(filenameUsers):
-        with open(filenameUsers, "w") as f:
-            json.dump({
-                "?": "Alle"
-            }, f, indent=4)
+    def publishWhenSaved(ticket, eventType, data, **kwargs):
+        """
+        Wartet, bis die Änderung gespeichert ist, und schickt danach das event an die Clients, sobald alle früheren Änderungen veröffentlicht sind.\n
+        Kann die Änderung nicht gespeichert werden, wird nichts veröffentlicht und der Client erhält "503 Service Unavailable".\n
+        """
+        nonlocal publishedTickets
+        saved = False
+        try:
+            waitUntilSaved()
+            saved = True
+        finally:
+            with publishLock:
+                # auch ohne Speichern ist das ticket erledigt, sonst warten alle späteren Änderungen vergeblich
+                publishLock.wait_for(lambda: publishedTickets == ticket)
+                try:
+                    if saved:
+                        chat.publish(eventType, data, **kwargs)
+                finally:
+                    publishedTickets += 1
+                    publishLock.notify_all()
 
-    # Alle Nachrichten abrufen
-    @api.GET("/api/")
+    # Alle Nachrichten abrufen, mit "?since=<id>" nur die Nachrichten nach der Nachricht mit dieser id
+    # mit "?user=<uuid>" nur die Nachrichten von und an diesen Benutzer sowie die Nachrichten an alle
+    # hat der Client den aktuellen Stand schon (ETag), antwortet der Server nur mit "304 Not Modified"
+    @api.GET("/api/", etag=lambda request: store.getMessagesTag())
     def get(request):
-        with open(filename) as f:
-            dataList = json.load(f)
+        user = request.args.get("user")
+        if "since" in request.args:
+            try:
+                since = int(request.args["since"])
+            except ValueError:
+                raise api_utils.UnprocessableEntity("Invalid format: 'since' must be of type int.")
+            return store.getMessagesSince(since, user)
+
+        dataList = store.getMessages(user)
         return dataList
 
+    # Typen der Einträge, welche der Client kennt, der Typ wird auch als event-Name im Stream verschickt
+    entryTypes = ("message", "keyExchange", "keyExchangeConfirmation")
+
     # Eine neue Nachricht hinzufügen
     @api.POST("/api/")
-    def post(request, content, fromUser:str, toUser:str, type:str):
-        # aktuelle Nachrichtenliste aufrufen
-        with open(filename) as f:
-            entryList = json.load(f)
+    def post(request, content, fromUser:str, toUser:str, type:str, encoding:str=None):
+        if type not in entryTypes:
+            raise api_utils.UnprocessableEntity(f"Invalid format: unknown type '{type}'.")
+        # nur registrierte Benutzer, die uuids werden auch als topics verwendet
+        for uuid in (fromUser, toUser):
+            if store.getUserName(uuid) is None:
+                raise api_utils.UnprocessableEntity(f"Invalid format: unknown user '{uuid}'.")
+
         # Headers zur neuen Nachricht hinzufügen
-        entryList.append({
+        entry = {
                 "type": type,
                 "from": fromUser,
                 "to": toUser,
                 "content": content
-            })
+            }
+
+        # verschlüsselte Nachrichten werden als base64 übertragen ("encoding": "base64") und als bytes gespeichert
+        if encoding is not None:
+            if encoding != "base64":
+                raise api_utils.UnprocessableEntity(f"Invalid format: unknown encoding '{encoding}'.")
+            entry["encoding"] = encoding
+        try:
+            storage.decodeEntry(entry)
+        except (ValueError, TypeError):
+            raise api_utils.UnprocessableEntity("Invalid format: 'content' must be base64 encoded.")
 
-        # Liste aktualisieren
-        with open("data.json", "w") as f:
-            json.dump(entryList, f, indent=4)
+        # abspeichern und an die verbundenen Clients schicken
+        # der Empfänger und der Sender bekommen die Nachricht über ihr eigenes topic, Nachrichten an alle ("?") bekommen alle
+        topics = ["?"] if toUser == "?" else [toUser, fromUser]
+        with publishLock:
+            store.addMessage(entry)
+            ticket = takeTicket()
+        publishWhenSaved(ticket, type, entry, topics=topics)
 
-        # Debug Nachricht für Client
-        return f'Server: Nachricht "{content}" mit Sender "{getUsers(None)[fromUser]}" und Empfänger "{getUsers(None)[toUser]}" wurde zu den Nachrichten Hinzugefügt.'
+        # Debug Nachricht für Client, die Namen kommen direkt aus der Benutzerliste im Speicher
+        return f'Server: Nachricht "{content}" mit Sender "{store.getUserName(fromUser)}" und Empfänger "{store.getUserName(toUser)}" wurde zu den Nachrichten Hinzugefügt.'
 
-    # Liste der Benutzer an Clients schicken
-    @api.GET("/api/users/")
+    # Liste der Benutzer an Clients schicken, mit "?since=<version>" nur die Benutzer, welche seit dieser Version der Liste dazugekommen sind
+    @api.GET("/api/users/", etag=lambda request: store.getUsersTag())
     def getUsers(request):
-        with open(filenameUsers) as f:
-            userList = json.load(f)
+        if "since" in request.args:
+            try:
+                since = int(request.args["since"])
+            except ValueError:
+                raise api_utils.UnprocessableEntity("Invalid format: 'since' must be of type int.")
+            return store.getUsersSince(since)
+
+        userList = store.getUsers()
         
         return userList
 
@@ -69,13 +180,10 @@ def main():
     @api.POST("/api/users/")
     def saveUsers(request, name:str):
         newUuid = str(uuid4()) # uuid (Universal Unique IDentifier) erstellen
-        with open(filenameUsers) as f:
-            userList = json.load(f)
-            # Benutzername wird unter dem uuid abgespeichert
-            userList[newUuid] = name
-
-        with open(filenameUsers, "w") as f:
-            json.dump(userList, f, indent=4)
+        # Benutzername wird unter dem uuid abgespeichert
+        store.addUser(newUuid, name)
+        waitUntilSaved()
+        chat.publish("user", {newUuid: name}, topic="?")
         
         # uuid wird an den Benutzer übergeben
         return newUuid
@@ -83,12 +191,34 @@ def main():
     # Alle Nachrichten löschen
     @api.DELETE("/api/")
     def delete(request):
-        with open(filename, "w") as f:
-            json.dump([], f)
+        # die gelöschten Nachrichten werden auch nicht mehr an Clients nachgeliefert, welche die Verbindung kurz verloren haben (reset)
+        with publishLock:
+            clearedId = store.clearMessages()
+            ticket = takeTicket()
+        publishWhenSaved(ticket, "clear", {"clearedId": clearedId}, topic="?", reset=True)
         
         return f"Server: Alle Nachrichten wurden gelöscht."
 
-    api_utils.run(api)
+    # Neue Einträge laufend an den Client schicken (server-sent events)
+    # mit "?user=<uuid>" bekommt der Client nur die Einträge von und an diesen Benutzer sowie die Einträge an alle
+    @api.GET("/api/stream/")
+    def stream(request):
+        user = request.args.get("user")
+        if user and store.getUserName(user) is None:
+            raise api_utils.UnprocessableEntity(f"Invalid format: unknown user '{user}'.")
+        topics = [user, "?"] if user else ["?"]
+        return chat.streaming_response(request, topics=topics)
+
+    try:
+        # Antworten werden komprimiert, falls der Client das unterstützt
+        # Im "production" Modus bedient eine feste Anzahl Threads die Verbindungen, welche für weitere requests offen bleiben (keep-alive)
+        # Die Streams der verbundenen Clients bekommen je einen eigenen Thread ausserhalb dieser Threads, damit sie keine anderen requests blockieren
+        # Nachrichten und Benutzer liegen im Arbeitsspeicher dieses Prozesses, darum wird nur ein Prozess (worker) gestartet
+        api_utils.run(api_utils.Compress(api), mode="production", workers=1, threads=64)
+    finally:
+        # ausstehende Änderungen beim Beenden sofort speichern
+        store.close()
+        chat.close()
 
 # Sicherstellen, dass der Server nicht durch importieren der Datei gestartet wird.
 if __name__ == "__main__":
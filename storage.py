@@ -0,0 +1,1276 @@
+# | ================================================================================ |
+# | Published under the GNU GENERAL PUBLIC LICENSE. Copyright © 2021 Mattia Metzler. |
+# | ================================================================================ |
+
+import atexit
+import base64
+import bisect
+import heapq
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import weakref
+from uuid import uuid4
+
+def legacyContentToBytes(content):
+    """
+    Wandelt ein als Objekt übertragenes Uint8Array ({"0": 17, "1": 203, ...}) in bytes um. Gibt None zurück, falls es kein solches Objekt ist.\n
+    """
+    try:
+        return bytes(content[str(i)] for i in range(len(content)))
+    except (KeyError, ValueError, TypeError):
+        return None
+
+def decodeEntry(entry):
+    """
+    Wandelt den Inhalt einer verschlüsselten Nachricht in bytes um. Verschlüsselte Nachrichten werden als base64 übertragen und gespeichert ("encoding": "base64").\n
+    Verschlüsselte Nachrichten aus älteren Versionen sind als Objekt ({"0": 17, "1": 203, ...}) gespeichert und werden ebenfalls umgewandelt.\n
+    Ist der Inhalt kein gültiges base64, gibt es einen ValueError bzw. TypeError.\n
+    """
+    content = entry.get("content")
+    if entry.get("encoding") == "base64":
+        if isinstance(content, str):
+            entry["content"] = base64.b64decode(content, validate=True)
+        elif not isinstance(content, (bytes, bytearray)):
+            raise TypeError(f"base64 content must be a string, not {content.__class__.__name__}")
+    elif isinstance(content, dict):
+        binary = legacyContentToBytes(content)
+        if binary is not None:
+            entry["content"] = binary
+            entry["encoding"] = "base64"
+    return entry
+
+def encodeBytes(data):
+    # bytes können nicht direkt als JSON gespeichert werden, sie werden deshalb als base64 gespeichert
+    if isinstance(data, (bytes, bytearray)):
+        return base64.b64encode(data).decode("ascii")
+    raise TypeError(f"Object of type {data.__class__.__name__} is not JSON serializable")
+
+
+class MessageJournal:
+    """
+    Speichert die Nachrichten als Journal: Jede Nachricht ist eine eigene Zeile JSON (newline-delimited JSON), welche an die Datei angehängt wird.\n
+    Beim Senden einer Nachricht wird so nur eine Zeile geschrieben, statt die ganze Datei neu zu schreiben. Die Position (offset) jeder Zeile wird im Speicher gehalten.\n
+    Eine bestehende Datei im alten Format (eine JSON-Liste, z.B. "data.json") wird beim Starten übernommen.\n
+    Mit `fsync` wartet jeder Schreibvorgang, bis die Daten wirklich auf der Festplatte sind und einen Absturz des Systems überstehen.\n
+
+    >>> import tempfile
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> filename = os.path.join(directory.name, "data.jsonl")
+    >>> legacyFilename = os.path.join(directory.name, "data.json")
+    >>> with open(legacyFilename, "w") as f:
+    ...     json.dump([{"type": "message", "from": "a", "to": "?", "content": "Hallo"},
+    ...                {"type": "message", "from": "a", "to": "b", "content": {"0": 1, "1": 2}}], f)
+
+    Die alte Datei wird übernommen und umbenannt, verschlüsselte Nachrichten werden als base64 gespeichert:
+    >>> journal = MessageJournal(filename, legacyFilename, fsync=False)
+    >>> journal.readAll()
+    [{'type': 'message', 'from': 'a', 'to': '?', 'content': 'Hallo'}, {'type': 'message', 'from': 'a', 'to': 'b', 'content': 'AQI=', 'encoding': 'base64'}]
+    >>> os.path.exists(legacyFilename), os.path.exists(legacyFilename + ".migrated")
+    (False, True)
+    >>> journal.append({"type": "message", "from": "b", "to": "a", "content": "Hi"})
+    >>> len(journal), journal.read(2)["content"]
+    (3, 'Hi')
+    >>> journal.close()
+
+    Eine unvollständige letzte Zeile (z.B. nach einem Absturz während dem Schreiben) wird beim Starten entfernt:
+    >>> with open(filename, "ab") as f:
+    ...     _ = f.write(b'{"type": "mess')
+    >>> journal = MessageJournal(filename, legacyFilename, fsync=False)
+    >>> len(journal), journal.readAll()[-1]["content"]
+    (3, 'Hi')
+    >>> open(filename, "rb").read().endswith(b'"Hi"}\\n')
+    True
+    >>> journal.close()
+    >>> directory.cleanup()
+    """
+
+    def __init__(self, filename="data.jsonl", legacyFilename="data.json", fsync=True):
+        self.filename = filename
+        self.fsync = fsync
+        self.offsets = [] # Position jeder Nachricht in der Datei
+        self.lock = threading.Lock()
+
+        # alte Datei übernehmen, falls noch kein Journal existiert
+        if not os.path.exists(filename) and legacyFilename and os.path.exists(legacyFilename):
+            self.migrate(legacyFilename)
+
+        self.file = open(filename, "a+b")
+        self.buildIndex()
+
+    def migrate(self, legacyFilename):
+        """
+        Übernimmt die Nachrichten aus einer JSON-Liste ins Journal. Die alte Datei wird danach umbenannt, damit sie nicht erneut übernommen wird.\n
+        Verschlüsselte Nachrichten werden dabei von der Objekt-Form in base64 umgewandelt.\n
+        """
+        with open(legacyFilename) as f:
+            entryList = json.load(f)
+
+        # zuerst in eine temporäre Datei schreiben, damit bei einem Absturz kein halbes Journal entsteht
+        with open(self.filename + ".tmp", "wb") as f:
+            for entry in entryList:
+                f.write(self.encode(decodeEntry(entry)))
+        os.replace(self.filename + ".tmp", self.filename)
+        os.replace(legacyFilename, legacyFilename + ".migrated")
+
+    def buildIndex(self):
+        """
+        Liest das Journal einmal durch und merkt sich die Position jeder Zeile. Eine unvollständige letzte Zeile (z.B. nach einem Absturz) wird entfernt.\n
+        """
+        self.file.seek(0)
+        position = 0
+        for line in self.file:
+            if not line.endswith(b"\n"):
+                break
+            self.offsets.append(position)
+            position += len(line)
+        self.file.truncate(position)
+
+    @staticmethod
+    def encode(entry):
+        return (json.dumps(entry, separators=(",", ":"), default=encodeBytes) + "\n").encode("utf-8")
+
+    def append(self, entry):
+        """
+        Hängt eine Nachricht ans Journal an.\n
+        """
+        self.extend([entry])
+
+    def extend(self, entryList):
+        """
+        Hängt mehrere Nachrichten mit einem einzigen Schreibvorgang ans Journal an. Schlägt das Schreiben fehl, bleibt das Journal unverändert.\n
+        """
+        lines = [self.encode(entry) for entry in entryList]
+        with self.lock:
+            position = self.file.seek(0, os.SEEK_END)
+            try:
+                self.file.write(b"".join(lines))
+                self.file.flush()
+                if self.fsync:
+                    os.fsync(self.file.fileno())
+            except BaseException:
+                # keine halben Einträge zurücklassen, die Nachrichten werden später erneut geschrieben
+                try:
+                    self.file.truncate(position)
+                except OSError:
+                    pass
+                raise
+            for line in lines:
+                self.offsets.append(position)
+                position += len(line)
+
+    def read(self, index):
+        """
+        Liest eine einzelne Nachricht anhand ihrer Position im Journal.\n
+        """
+        with self.lock:
+            self.file.seek(self.offsets[index])
+            return json.loads(self.file.readline())
+
+    def readAll(self):
+        """
+        Gibt alle Nachrichten als Liste zurück (gleiches Format wie früher "data.json").\n
+        """
+        with self.lock:
+            self.file.seek(0)
+            data = self.file.read()
+        return [json.loads(line) for line in data.splitlines()]
+
+    def rewrite(self, entryList):
+        """
+        Ersetzt das ganze Journal durch die Einträge in `entryList` und gibt die Anzahl freigegebener Bytes zurück.\n
+        """
+        lines = [self.encode(entry) for entry in entryList]
+        with self.lock:
+            sizeBefore = self.file.seek(0, os.SEEK_END)
+            # zuerst in eine temporäre Datei schreiben, damit bei einem Absturz kein halbes Journal entsteht
+            with open(self.filename + ".tmp", "wb") as f:
+                f.write(b"".join(lines))
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.file.close()
+            os.replace(self.filename + ".tmp", self.filename)
+            self.file = open(self.filename, "a+b")
+            self.offsets = []
+            position = 0
+            for line in lines:
+                self.offsets.append(position)
+                position += len(line)
+            return sizeBefore - position
+
+    def clear(self):
+        """
+        Löscht alle Nachrichten.\n
+        """
+        with self.lock:
+            self.file.truncate(0)
+            self.offsets = []
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+def withoutIds(entryList, ids, removedIds):
+    """
+    Gibt die Einträge aus `entryList` und ihre `ids` ohne die Einträge mit den ids in `removedIds` zurück. Alle ids müssen sortiert sein.\n
+    Die Listen werden stückweise kopiert, statt jeden Eintrag einzeln zu prüfen.\n
+
+    >>> withoutIds(["a", "b", "c", "d"], [1, 3, 4, 6], [3, 5, 6])
+    (['a', 'c'], [1, 4])
+    """
+    keptEntries = []
+    keptIds = []
+    start = 0
+    for id in removedIds:
+        position = bisect.bisect_left(ids, id, start)
+        if position < len(ids) and ids[position] == id:
+            keptEntries += entryList[start:position]
+            keptIds += ids[start:position]
+            start = position + 1
+    keptEntries += entryList[start:]
+    keptIds += ids[start:]
+    return keptEntries, keptIds
+
+def readEntries(entryList):
+    """
+    Liest die Einträge eines Journals und gibt die Nachrichten, die höchste vergebene id (lastId) und die id des letzten Löschens (clearedId) zurück.\n
+
+    Nachrichten ohne id werden nach der vorherigen id nummeriert:
+    >>> messages, lastId, clearedId = readEntries([{"type": "message", "content": "a"}, {"type": "message", "content": "b"}])
+    >>> [entry["id"] for entry in messages], lastId, clearedId
+    ([1, 2], 2, 0)
+
+    Nach dem Löschen (clearedId) und dem Entfernen alter Nachrichten (lastId) werden die ids nicht wiederverwendet:
+    >>> readEntries([{"clearedId": 5}, {"type": "message", "content": "a"}])
+    ([{'type': 'message', 'content': 'a', 'id': 6}], 6, 5)
+    >>> readEntries([{"clearedId": 5}, {"lastId": 9}])
+    ([], 9, 5)
+    >>> readEntries([{"lastId": 9}, {"type": "message", "content": "a", "id": 7}])
+    ([{'type': 'message', 'content': 'a', 'id': 7}], 9, 0)
+    """
+    # Jede Nachricht hat eine fortlaufende id. Nachrichten aus älteren Versionen ohne id werden nachträglich nummeriert.
+    # Nach dem Löschen aller Nachrichten steht im Journal nur eine Markierung mit der id des Löschens (clearedId).
+    # Nach dem Entfernen alter Nachrichten (compact) steht am Anfang eine Markierung mit der höchsten bisher vergebenen id (lastId).
+    messages = []
+    lastId = 0
+    clearedId = 0
+    for entry in entryList:
+        if "clearedId" in entry:
+            lastId = clearedId = entry["clearedId"]
+            continue
+        if "lastId" in entry:
+            lastId = max(lastId, entry["lastId"])
+            continue
+        try:
+            decodeEntry(entry)
+        except (ValueError, TypeError):
+            pass # fehlerhafte Einträge älterer Versionen werden unverändert übernommen
+        if "id" not in entry:
+            entry["id"] = lastId + 1
+        lastId = max(lastId, entry["id"])
+        messages.append(entry)
+    return messages, lastId, clearedId
+
+def readJsonFiles(filename="data.jsonl", filenameUsers="users.json", legacyFilename="data.json"):
+    """
+    Liest die Nachrichten und Benutzer aus den Dateien von `Store`, ohne etwas zu verändern (z.B. für eine Migration). Gibt die Nachrichten, lastId, clearedId und die Benutzer zurück.\n
+    """
+    if os.path.exists(filename):
+        with open(filename, "rb") as f:
+            entryList = [json.loads(line) for line in f if line.endswith(b"\n")]
+    elif legacyFilename and os.path.exists(legacyFilename):
+        with open(legacyFilename) as f:
+            entryList = json.load(f)
+    else:
+        entryList = []
+    messages, lastId, clearedId = readEntries(entryList)
+
+    if os.path.exists(filenameUsers):
+        with open(filenameUsers) as f:
+            users = json.load(f)
+    else:
+        users = {"?": "Alle"}
+    return messages, lastId, clearedId, users
+
+
+class BaseStore:
+    """
+    Schnittstelle zum Speichern der Nachrichten und Benutzer, welche die Handler in server.py verwenden. Implementiert von `Store` (JSON-Dateien) und `SqliteStore` (SQLite-Datenbank).\n
+    Alte Nachrichten werden alle `compactInterval` Sekunden entfernt (siehe `compact`):\n
+    - `maxAge`: Nachrichten, welche älter sind als so viele Sekunden\n
+    - `maxMessagesPerConversation`: die ältesten Nachrichten (Typ "message") eines Gesprächs, sobald es mehr als so viele hat\n
+    - `keyExchangeTtl`: Schlüsselaustausche ("keyExchange", "keyExchangeConfirmation"), welche älter sind als so viele Sekunden\n
+    Mit None wird die jeweilige Regel nicht angewendet.\n
+    """
+
+    keyExchangeTypes = ("keyExchange", "keyExchangeConfirmation")
+
+    def __init__(self, maxAge=None, maxMessagesPerConversation=None, keyExchangeTtl=None, compactInterval=60.0):
+        self.maxAge = maxAge
+        self.maxMessagesPerConversation = maxMessagesPerConversation
+        self.keyExchangeTtl = keyExchangeTtl
+        self.compactInterval = compactInterval
+
+        # Versionen der Nachrichten und Benutzer, werden bei jeder Änderung erhöht (für ETags)
+        # die instanceId unterscheidet die Versionen nach einem Neustart des Servers
+        self.instanceId = uuid4().hex[:8]
+        self.messagesVersion = 0
+        self.usersVersion = 0
+
+    def getMessagesTag(self):
+        """
+        Gibt einen ETag für den aktuellen Stand der Nachrichten zurück. Solange sich die Nachrichten nicht ändern, bleibt er gleich.\n
+        """
+        return f"{self.instanceId}-{self.messagesVersion}"
+
+    def getUsersTag(self):
+        """
+        Gibt einen ETag für den aktuellen Stand der Benutzerliste zurück.\n
+        """
+        return f"{self.instanceId}-{self.usersVersion}"
+
+    def expiryTime(self, entry):
+        """
+        Gibt die Zeit zurück, nach welcher die Nachricht gemäss `maxAge` bzw. `keyExchangeTtl` entfernt wird, oder None.\n
+        Nachrichten aus älteren Versionen ohne Zeit ("time") werden nur wegen `maxMessagesPerConversation` entfernt.\n
+        """
+        if "time" not in entry:
+            return None
+        ages = [self.maxAge]
+        if entry["type"] in self.keyExchangeTypes:
+            ages.append(self.keyExchangeTtl)
+        return min((entry["time"] + age for age in ages if age is not None), default=None)
+
+    def conversation(self, entry):
+        """
+        Gibt das Gespräch zurück, zu welchem die Nachricht für `maxMessagesPerConversation` zählt, oder None.\n
+        Nachrichten an alle bilden ein Gespräch, sonst die beiden Benutzer zusammen.\n
+        """
+        if self.maxMessagesPerConversation is None or entry["type"] != "message":
+            return None
+        return "?" if entry["to"] == "?" else frozenset((entry["from"], entry["to"]))
+
+    def getMessages(self, user=None):
+        """
+        Gibt die Nachrichten zurück, mit `user` nur die Nachrichten von und an diesen Benutzer sowie die Nachrichten an alle.\n
+        """
+        raise NotImplementedError()
+
+    def getMessagesSince(self, since, user=None):
+        """
+        Gibt die Nachrichten zurück, welche neuer sind als die Nachricht mit der id `since`, zusammen mit der höchsten id (lastId).\n
+        Wurden die Nachrichten seither gelöscht oder ist die id unbekannt, werden alle Nachrichten zurückgegeben und "reset" ist True.\n
+        """
+        raise NotImplementedError()
+
+    def addMessage(self, entry):
+        """
+        Fügt eine Nachricht hinzu und gibt ihre id zurück.\n
+        """
+        raise NotImplementedError()
+
+    def clearMessages(self):
+        """
+        Löscht alle Nachrichten und gibt die id des Löschens zurück.\n
+        """
+        raise NotImplementedError()
+
+    def getUsers(self):
+        """
+        Gibt die Benutzerliste (uuid -> Name) zurück.\n
+        """
+        raise NotImplementedError()
+
+    def getUsersSince(self, since):
+        """
+        Gibt die Benutzer zurück, welche nach der Version `since` der Benutzerliste registriert wurden, zusammen mit der aktuellen Version.\n
+        """
+        raise NotImplementedError()
+
+    def getUserName(self, uuid):
+        """
+        Gibt den Namen des Benutzers mit diesem uuid zurück, oder None falls es ihn nicht gibt.\n
+        """
+        raise NotImplementedError()
+
+    def addUser(self, uuid, name):
+        """
+        Speichert einen neuen Benutzer unter seinem uuid.\n
+        """
+        raise NotImplementedError()
+
+    def compact(self, now=None):
+        """
+        Entfernt die alten Nachrichten und gibt die Anzahl entfernter Nachrichten sowie der freigegebenen Bytes zurück.\n
+        """
+        raise NotImplementedError()
+
+    def waitUntilSaved(self, timeout=None):
+        """
+        Wartet, bis alle bisherigen Änderungen gespeichert sind. Gibt False zurück, falls das nicht innerhalb von `timeout` Sekunden passiert.\n
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+
+class Store(BaseStore):
+    """
+    Hält alle Nachrichten und Benutzer des Servers im Arbeitsspeicher. Anfragen werden direkt aus dem Speicher beantwortet, ohne die Dateien zu lesen.\n
+    Änderungen werden von einem einzigen Hintergrund-Thread gespeichert (write-behind). Nach der ersten Änderung sammelt er während `flushInterval` Sekunden weitere Änderungen, höchstens `maxBatchSize` Nachrichten,
+    und speichert sie mit einem einzigen Schreibvorgang und, falls `fsync`, einem einzigen fsync (group commit). Mit `waitUntilSaved` kann auf das Speichern gewartet werden.\n
+    Beim Beenden des Servers wird alles noch ausstehende sofort gespeichert. Alte Nachrichten werden vom gleichen Thread entfernt (siehe `BaseStore`).\n
+
+    >>> import tempfile
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> def openStore(**kwargs):
+    ...     return Store(os.path.join(directory.name, "data.jsonl"), os.path.join(directory.name, "users.json"), None, fsync=False, **kwargs)
+    >>> store = openStore(flushInterval=0.5)
+    >>> store.addUser("a", "Anna")
+    >>> store.addMessage({"type": "message", "from": "a", "to": "?", "content": "Hallo"})
+    1
+    >>> store.addMessage({"type": "message", "from": "a", "to": "b", "content": "Hallo b"})
+    2
+    >>> store.addMessage({"type": "message", "from": "b", "to": "c", "content": "Hallo c"})
+    3
+
+    Die Änderungen werden gesammelt und erst nach `flushInterval` zusammen gespeichert:
+    >>> len(store.journal), store.waitUntilSaved(timeout=0)
+    (0, False)
+    >>> store.waitUntilSaved(timeout=5), len(store.journal)
+    (True, 3)
+
+    Mit `user` nur die Nachrichten von und an diesen Benutzer sowie die Nachrichten an alle:
+    >>> [entry["id"] for entry in store.getMessages("b")], [entry["id"] for entry in store.getMessages("a")]
+    ([1, 2, 3], [1, 2])
+    >>> result = store.getMessagesSince(1, "c")
+    >>> [entry["id"] for entry in result["messages"]], result["lastId"], result["reset"]
+    ([3], 3, False)
+
+    Nach dem Löschen oder mit einer unbekannten id erhält der Client alle Nachrichten und "reset":
+    >>> store.clearMessages()
+    4
+    >>> store.addMessage({"type": "message", "from": "a", "to": "?", "content": "Neu"})
+    5
+    >>> result = store.getMessagesSince(3)
+    >>> [entry["id"] for entry in result["messages"]], result["lastId"], result["reset"]
+    ([5], 5, True)
+    >>> store.getMessagesSince(4)["reset"], store.getMessagesSince(99)["reset"]
+    (False, True)
+    >>> store.getUsersSince(1)
+    {'users': {'a': 'Anna'}, 'version': 2, 'reset': False}
+    >>> store.close()
+
+    Nach einem Neustart ist alles wieder da:
+    >>> store = openStore()
+    >>> [entry["id"] for entry in store.getMessages()], store.lastId, store.clearedId, store.getUsers()
+    ([5], 5, 4, {'?': 'Alle', 'a': 'Anna'})
+    >>> store.close()
+    >>> directory.cleanup()
+    """
+
+    def __init__(self, filename="data.jsonl", filenameUsers="users.json", legacyFilename="data.json", flushInterval=1.0,
+                 maxAge=None, maxMessagesPerConversation=None, keyExchangeTtl=None, compactInterval=60.0, maxBatchSize=1000, fsync=True):
+        super().__init__(maxAge, maxMessagesPerConversation, keyExchangeTtl, compactInterval)
+        self.filenameUsers = filenameUsers
+        self.flushInterval = flushInterval
+        self.maxBatchSize = maxBatchSize
+        self.fsync = fsync
+        self.lock = threading.Lock() # schützt die Daten im Speicher
+        self.changed = threading.Condition(self.lock) # weckt den Hintergrund-Thread und die auf das Speichern wartenden Threads
+        self.flushLock = threading.Lock() # verhindert, dass zwei Threads gleichzeitig speichern
+
+        # Nachrichten einmalig vom Journal laden
+        self.journal = MessageJournal(filename, legacyFilename, fsync=fsync)
+        self.messages, self.lastId, self.clearedId = readEntries(self.journal.readAll())
+        self.messageIds = [entry["id"] for entry in self.messages] # für die binäre Suche nach einer id
+
+        # Index pro uuid mit allen Nachrichten von und an diesen Benutzer, Nachrichten an alle stehen unter "?"
+        self.userMessages = {}
+        self.userMessageIds = {}
+        # für das Entfernen alter Nachrichten (compact), damit nicht jedes Mal alle Nachrichten durchgegangen werden:
+        # Heap mit (Ablaufzeit, id), ids der Nachrichten pro Gespräch und die Gespräche mit zu vielen Nachrichten
+        self.expiryHeap = []
+        self.conversationIds = {}
+        self.crowdedConversations = set()
+        for entry in self.messages:
+            self.indexMessage(entry)
+            self.trackExpiry(entry)
+
+        # Benutzer einmalig laden, falls die Datei noch nicht existiert wird sie beim nächsten Speichern erstellt
+        if os.path.exists(filenameUsers):
+            with open(filenameUsers) as f:
+                self.users = json.load(f)
+            self.usersChanged = False
+        else:
+            self.users = {"?": "Alle"}
+            self.usersChanged = True
+        # uuids in der Reihenfolge der Registrierung, die Anzahl ist die Version der Benutzerliste (für "?since=<version>")
+        self.userOrder = list(self.users)
+
+        # noch nicht gespeicherte Änderungen, jede Änderung erhält eine fortlaufende Nummer
+        # Nachrichten werden als (Nummer, Nachricht) gespeichert, savedChange ist die Nummer, bis zu welcher alles gespeichert ist
+        self.lastChange = 0
+        self.savedChange = 0
+        self.pendingMessages = []
+        self.messagesCleared = False
+        # Anzahl Nachrichten, welche seit dem letzten Neuschreiben des Journals entfernt wurden, aber noch in der Datei stehen
+        self.removedSinceRewrite = 0
+
+        self.stopEvent = threading.Event()
+        self.flushThread = threading.Thread(target=self.run, name="store-flush", daemon=True)
+        self.flushThread.start()
+        atexit.register(self.close)
+
+    def indexMessage(self, entry, userMessages=None, userMessageIds=None):
+        if userMessages is None:
+            userMessages, userMessageIds = self.userMessages, self.userMessageIds
+        for uuid in {entry["from"], entry["to"]}:
+            userMessages.setdefault(uuid, []).append(entry)
+            userMessageIds.setdefault(uuid, []).append(entry["id"])
+
+    def trackExpiry(self, entry):
+        """
+        Merkt sich, wann die Nachricht gemäss `maxAge` bzw. `keyExchangeTtl` abläuft und zu welchem Gespräch sie zählt (siehe `BaseStore`).\n
+        Muss mit gesperrtem `self.lock` aufgerufen werden.\n
+        """
+        expires = self.expiryTime(entry)
+        if expires is not None:
+            heapq.heappush(self.expiryHeap, (expires, entry["id"]))
+        conversation = self.conversation(entry)
+        if conversation is not None:
+            ids = self.conversationIds.setdefault(conversation, [])
+            ids.append(entry["id"])
+            if len(ids) > self.maxMessagesPerConversation:
+                self.crowdedConversations.add(conversation)
+
+    def selectMessages(self, since, user):
+        """
+        Wählt die Nachrichten nach der id `since` aus. Mit `user` nur die Nachrichten von und an diesen Benutzer sowie die Nachrichten an alle.\n
+        Muss mit gesperrtem `self.lock` aufgerufen werden.\n
+        """
+        if user is None:
+            return self.messages[bisect.bisect_right(self.messageIds, since):]
+
+        def newerMessages(uuid):
+            ids = self.userMessageIds.get(uuid, [])
+            return self.userMessages.get(uuid, [])[bisect.bisect_right(ids, since):]
+
+        ownMessages = newerMessages(user)
+        if user == "?":
+            return ownMessages
+
+        # beide Listen sind nach id sortiert, eigene Nachrichten an alle kommen in beiden vor und werden nur einmal übernommen
+        messageList = []
+        for entry in heapq.merge(ownMessages, newerMessages("?"), key=lambda entry: entry["id"]):
+            if not messageList or messageList[-1] is not entry:
+                messageList.append(entry)
+        return messageList
+
+    def getMessages(self, user=None):
+        """
+        Gibt eine Kopie der Nachrichtenliste zurück, mit `user` nur die Nachrichten von und an diesen Benutzer sowie die Nachrichten an alle.\n
+        """
+        with self.lock:
+            return self.selectMessages(0, user)
+
+    def getMessagesSince(self, since, user=None):
+        """
+        Gibt die Nachrichten zurück, welche neuer sind als die Nachricht mit der id `since`, zusammen mit der höchsten id (lastId).\n
+        Wurden die Nachrichten seither gelöscht oder ist die id unbekannt, werden alle Nachrichten zurückgegeben und "reset" ist True. Der Client muss dann seine Liste neu aufbauen.\n
+        """
+        with self.lock:
+            # der Client kennt noch Nachrichten von vor dem Löschen oder hat eine unbekannte id
+            reset = since < self.clearedId or since > self.lastId
+            if reset:
+                since = 0
+            return {
+                "messages": self.selectMessages(since, user),
+                "lastId": self.lastId,
+                "reset": reset
+            }
+
+    def addMessage(self, entry):
+        """
+        Fügt eine Nachricht hinzu und gibt ihre id zurück. Sie wird beim nächsten Durchgang des Hintergrund-Threads gespeichert.\n
+        """
+        with self.lock:
+            self.lastId += 1
+            entry["id"] = self.lastId
+            entry["time"] = int(time.time()) # für das Entfernen alter Nachrichten (compact)
+            self.messages.append(entry)
+            self.messageIds.append(self.lastId)
+            self.indexMessage(entry)
+            self.trackExpiry(entry)
+            self.messagesVersion += 1
+            self.lastChange += 1
+            self.pendingMessages.append((self.lastChange, entry))
+            self.changed.notify_all()
+            return self.lastId
+
+    def clearMessages(self):
+        """
+        Löscht alle Nachrichten und gibt die id des Löschens zurück. Das Löschen erhält selbst eine id, damit Clients mit älteren Nachrichten ihre Liste neu aufbauen. Die ids werden danach nicht wiederverwendet.\n
+        """
+        with self.lock:
+            self.lastId += 1
+            self.clearedId = self.lastId
+            self.messages = []
+            self.messageIds = []
+            self.userMessages = {}
+            self.userMessageIds = {}
+            self.expiryHeap = []
+            self.conversationIds = {}
+            self.crowdedConversations = set()
+            self.messagesVersion += 1
+            self.pendingMessages = []
+            self.messagesCleared = True
+            self.lastChange += 1
+            self.changed.notify_all()
+            return self.clearedId
+
+    def compact(self, now=None):
+        """
+        Entfernt die alten Nachrichten (siehe `BaseStore`) und gibt die Anzahl entfernter Nachrichten sowie der freigegebenen Bytes zurück.\n
+        Es werden nur die Nachrichten angeschaut, welche seit dem letzten Mal abgelaufen sein können: ein Heap liefert die Nachrichten nach ihrer Ablaufzeit,
+        und nur Gespräche mit neuen Nachrichten werden gezählt. Die Listen werden stückweise kopiert, ohne jede Nachricht einzeln anzuschauen.\n
+        Die Datei wird erst neu geschrieben, wenn mindestens ein Viertel ihrer Einträge entfernt wurde. Bis dahin werden die Nachrichten nach einem Neustart erneut entfernt.\n
+
+        >>> import tempfile
+        >>> directory = tempfile.TemporaryDirectory()
+        >>> def openStore(**kwargs):
+        ...     return Store(os.path.join(directory.name, "data.jsonl"), os.path.join(directory.name, "users.json"), None, fsync=False,
+        ...                  maxAge=3600, maxMessagesPerConversation=2, keyExchangeTtl=60, **kwargs)
+        >>> store = openStore()
+        >>> for i in range(4):
+        ...     _ = store.addMessage({"type": "message", "from": "a", "to": "b", "content": i})
+        >>> _ = store.addMessage({"type": "message", "from": "b", "to": "a", "content": "Antwort"})
+        >>> _ = store.addMessage({"type": "keyExchange", "from": "a", "to": "b", "content": "Schlüssel"})
+        >>> _ = store.addMessage({"type": "message", "from": "a", "to": "?", "content": "Hallo"})
+        >>> _ = store.addMessage({"type": "message", "from": "b", "to": "?", "content": "Hallo"})
+        >>> store.flush()
+        >>> now = time.time()
+
+        Von einem Gespräch bleiben nur die `maxMessagesPerConversation` neusten Nachrichten. Damit sind genug Einträge entfernt, um das Journal neu zu schreiben:
+        >>> removed, reclaimed = store.compact(now)
+        >>> removed, reclaimed > 0, [entry["id"] for entry in store.getMessages()], len(store.journal)
+        (3, True, [4, 5, 6, 7, 8], 6)
+
+        Schlüsselaustausche werden nach `keyExchangeTtl` Sekunden entfernt, alle anderen Nachrichten nach `maxAge`.
+        Ein entfernter Eintrag reicht nicht für ein Neuschreiben:
+        >>> store.compact(now + 120)
+        (1, 0)
+        >>> [entry["id"] for entry in store.getMessages()], len(store.journal)
+        ([4, 5, 7, 8], 6)
+        >>> store.close()
+
+        Nach einem Neustart werden die Nachrichten deshalb erneut entfernt:
+        >>> store = openStore()
+        >>> store.compact(now + 120)
+        (1, 0)
+        >>> removed, reclaimed = store.compact(now + 7200)
+        >>> removed, reclaimed > 0, len(store.journal)
+        (4, True, 1)
+        >>> store.close()
+
+        Die ids werden auch nach dem Entfernen aller Nachrichten nicht wiederverwendet:
+        >>> store = openStore()
+        >>> store.getMessages(), store.addMessage({"type": "message", "from": "a", "to": "b", "content": "neu"})
+        ([], 9)
+        >>> store.close()
+        >>> directory.cleanup()
+        """
+        if now is None:
+            now = time.time()
+        reclaimed = 0
+        with self.lock:
+            # nur die Nachrichten, deren Ablaufzeit vorbei ist, der Heap kann noch ids bereits entfernter Nachrichten enthalten
+            expiredIds = set()
+            while self.expiryHeap and self.expiryHeap[0][0] < now:
+                expiredIds.add(heapq.heappop(self.expiryHeap)[1])
+            expiredEntries = []
+            for id in sorted(expiredIds):
+                position = bisect.bisect_left(self.messageIds, id)
+                if position < len(self.messageIds) and self.messageIds[position] == id:
+                    expiredEntries.append(self.messages[position])
+            # abgelaufene Nachrichten zählen nicht mehr zu ihrem Gespräch
+            for entry in expiredEntries:
+                conversation = self.conversation(entry)
+                if conversation is not None:
+                    ids = self.conversationIds[conversation]
+                    del ids[bisect.bisect_left(ids, entry["id"])]
+
+            # nur die Gespräche, welche seit dem letzten Mal zu viele Nachrichten bekommen haben
+            for conversation in self.crowdedConversations:
+                ids = self.conversationIds[conversation]
+                count = len(ids) - self.maxMessagesPerConversation
+                for id in ids[:max(count, 0)]:
+                    expiredEntries.append(self.messages[bisect.bisect_left(self.messageIds, id)])
+                del ids[:max(count, 0)]
+            self.crowdedConversations = set()
+
+            if expiredEntries:
+                expiredIds = sorted(entry["id"] for entry in expiredEntries)
+                self.messages, self.messageIds = withoutIds(self.messages, self.messageIds, expiredIds)
+                # nur die Listen der betroffenen Benutzer neu aufbauen
+                for uuid in {uuid for entry in expiredEntries for uuid in (entry["from"], entry["to"])}:
+                    self.userMessages[uuid], self.userMessageIds[uuid] = withoutIds(self.userMessages[uuid], self.userMessageIds[uuid], expiredIds)
+                pendingCount = len(self.pendingMessages)
+                expiredIds = set(expiredIds)
+                self.pendingMessages = [(change, entry) for change, entry in self.pendingMessages if entry["id"] not in expiredIds]
+                self.messagesVersion += 1
+                # noch nicht gespeicherte Nachrichten stehen nicht in der Datei
+                self.removedSinceRewrite += len(expiredIds) - (pendingCount - len(self.pendingMessages))
+
+        # ausstehende Nachrichten zuerst speichern, damit die freigegebenen Bytes stimmen
+        # die Datei wird vom Hintergrund-Thread geschrieben, darum hier ebenfalls mit flushLock
+        self.flush()
+        with self.flushLock:
+            if self.removedSinceRewrite * 4 >= max(len(self.journal), 1):
+                with self.lock:
+                    # ausstehende Nachrichten und Benutzer werden mit dem neuen Journal gespeichert
+                    pendingMessages, self.pendingMessages = self.pendingMessages, []
+                    messagesCleared, self.messagesCleared = self.messagesCleared, False
+                    userList = dict(self.users) if self.usersChanged else None
+                    self.usersChanged = False
+                    removedSinceRewrite, self.removedSinceRewrite = self.removedSinceRewrite, 0
+                    clearedId = self.clearedId
+                    entryList = [{"clearedId": self.clearedId}] if self.clearedId else []
+                    entryList.append({"lastId": self.lastId})
+                    entryList.extend(self.messages)
+                    lastChange = self.lastChange
+                try:
+                    if userList is not None:
+                        self.writeUsers(userList)
+                        userList = None
+                    reclaimed = self.journal.rewrite(entryList)
+                except BaseException:
+                    self.restorePending(pendingMessages, messagesCleared, clearedId, userList)
+                    with self.lock:
+                        self.removedSinceRewrite += removedSinceRewrite
+                    raise
+                self.markSaved(lastChange)
+        return len(expiredEntries), reclaimed
+
+    def getUsers(self):
+        """
+        Gibt eine Kopie der Benutzerliste (uuid -> Name) zurück.\n
+        """
+        with self.lock:
+            return dict(self.users)
+
+    def getUsersSince(self, since):
+        """
+        Gibt die Benutzer zurück, welche nach der Version `since` der Benutzerliste registriert wurden, zusammen mit der aktuellen Version.\n
+        Ist die Version unbekannt, werden alle Benutzer zurückgegeben und "reset" ist True. Der Client muss dann seine Liste neu aufbauen.\n
+        """
+        with self.lock:
+            version = len(self.userOrder)
+            reset = since < 0 or since > version
+            if reset:
+                since = 0
+            return {
+                "users": {uuid: self.users[uuid] for uuid in self.userOrder[since:]},
+                "version": version,
+                "reset": reset
+            }
+
+    def getUserName(self, uuid):
+        """
+        Gibt den Namen des Benutzers mit diesem uuid zurück, oder None falls es ihn nicht gibt.\n
+        """
+        return self.users.get(uuid)
+
+    def addUser(self, uuid, name):
+        """
+        Speichert einen neuen Benutzer unter seinem uuid.\n
+        """
+        with self.lock:
+            if uuid not in self.users:
+                self.userOrder.append(uuid)
+            self.users[uuid] = name
+            self.usersVersion += 1
+            self.usersChanged = True
+            self.lastChange += 1
+            self.changed.notify_all()
+
+    def flush(self, maxBatchSize=None):
+        """
+        Speichert die ausstehenden Änderungen auf die Festplatte, mit `maxBatchSize` höchstens so viele Nachrichten.\n
+        """
+        with self.flushLock:
+            # ausstehende Änderungen übernehmen, damit die Daten während dem Schreiben nicht gesperrt sind
+            with self.lock:
+                pendingMessages = self.pendingMessages[:maxBatchSize]
+                self.pendingMessages = self.pendingMessages[len(pendingMessages):]
+                # ohne die restlichen Nachrichten ist alles bis vor der ersten von ihnen gespeichert
+                lastChange = self.pendingMessages[0][0] - 1 if self.pendingMessages else self.lastChange
+                messagesCleared, self.messagesCleared = self.messagesCleared, False
+                clearedId = self.clearedId
+                userList = dict(self.users) if self.usersChanged else None
+                self.usersChanged = False
+
+            # schlägt das Schreiben fehl, bleiben die noch nicht geschriebenen Änderungen ausstehend und gelten nicht als gespeichert
+            try:
+                if messagesCleared:
+                    self.journal.clear()
+                    self.journal.append({"clearedId": clearedId})
+                    messagesCleared = False
+                if pendingMessages:
+                    self.journal.extend([entry for change, entry in pendingMessages])
+                    pendingMessages = []
+                if userList is not None:
+                    self.writeUsers(userList)
+            except BaseException:
+                self.restorePending(pendingMessages, messagesCleared, clearedId, userList)
+                raise
+            self.markSaved(lastChange)
+
+    def writeUsers(self, userList):
+        # zuerst in eine temporäre Datei schreiben, damit bei einem Absturz keine halbe Datei entsteht
+        with open(self.filenameUsers + ".tmp", "w") as f:
+            json.dump(userList, f, indent=4)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(self.filenameUsers + ".tmp", self.filenameUsers)
+
+    def restorePending(self, pendingMessages, messagesCleared, clearedId, userList):
+        """
+        Stellt nach einem fehlgeschlagenen Schreibvorgang die nicht geschriebenen Änderungen wieder als ausstehend ein, damit sie beim nächsten Mal gespeichert werden.\n
+        """
+        with self.lock:
+            if messagesCleared:
+                self.messagesCleared = True
+            # wurden die Nachrichten inzwischen gelöscht, werden sie nicht mehr gespeichert
+            if pendingMessages and self.clearedId == clearedId:
+                self.pendingMessages = pendingMessages + self.pendingMessages
+            if userList is not None:
+                self.usersChanged = True
+
+    def markSaved(self, change):
+        with self.lock:
+            self.savedChange = max(self.savedChange, change)
+            self.changed.notify_all()
+
+    def waitUntilSaved(self, timeout=None):
+        """
+        Wartet, bis alle bisherigen Änderungen auf der Festplatte gespeichert sind. Gibt False zurück, falls das nicht innerhalb von `timeout` Sekunden passiert.\n
+        """
+        with self.lock:
+            change = self.lastChange
+            return self.changed.wait_for(lambda: self.savedChange >= change, timeout)
+
+    def run(self):
+        nextCompaction = time.monotonic() + self.compactInterval
+        while not self.stopEvent.is_set():
+            with self.lock:
+                # auf die erste Änderung warten, danach während flushInterval weitere Änderungen sammeln (group commit)
+                if self.changed.wait_for(lambda: self.lastChange > self.savedChange or self.stopEvent.is_set(),
+                                         max(nextCompaction - time.monotonic(), 0)):
+                    self.changed.wait_for(lambda: len(self.pendingMessages) >= self.maxBatchSize or self.stopEvent.is_set(),
+                                          self.flushInterval)
+            if self.stopEvent.is_set():
+                break
+            try:
+                self.flush(self.maxBatchSize)
+                if time.monotonic() >= nextCompaction:
+                    removed, reclaimed = self.compact()
+                    if removed or reclaimed:
+                        print(f"Store: {removed} alte Nachrichten entfernt, {reclaimed} Bytes freigegeben", file=sys.stderr)
+                    nextCompaction = time.monotonic() + self.compactInterval
+            except Exception:
+                # z.B. Festplatte voll, es wird nach einer Sekunde erneut versucht
+                traceback.print_exc()
+                self.stopEvent.wait(1.0)
+
+    def close(self):
+        """
+        Beendet den Hintergrund-Thread und speichert alle ausstehenden Änderungen.\n
+        """
+        if self.stopEvent.is_set():
+            return
+        with self.lock:
+            self.stopEvent.set()
+            self.changed.notify_all()
+        self.flushThread.join()
+        self.flush()
+        self.journal.close()
+        atexit.unregister(self.close)
+
+
+class ThreadConnection:
+    """
+    Hält die Verbindung eines Threads zur Datenbank (in threading.local). Endet der Thread, wird sie sofort geschlossen.\n
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __del__(self):
+        self.db.close()
+
+
+class SqliteStore(BaseStore):
+    """
+    Speichert Nachrichten und Benutzer in einer SQLite-Datenbank, mit der gleichen Schnittstelle wie `Store` (siehe `BaseStore`).\n
+    Die Datenbank läuft im WAL-Modus, dadurch können beliebig viele Threads gleichzeitig lesen, während ein Thread schreibt. Jeder Thread hat eine eigene Verbindung,
+    welche für weitere requests offen bleibt und mit dem Thread geschlossen wird. Die Abfragen sind fest, sqlite3 bereitet sie deshalb pro Verbindung nur einmal vor (prepared statements).\n
+    Die Nachrichten eines Benutzers werden über die Indexe auf ("to", id) und ("from", id) gefunden, statt alle Nachrichten durchzugehen.\n
+    Jede Änderung ist nach dem Schreiben gespeichert, mit `fsync` auch nach einem Absturz des Systems. Alte Nachrichten werden von einem Hintergrund-Thread entfernt.\n
+
+    Die Ergebnisse sind die gleichen wie mit `Store`:
+    >>> import tempfile
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> stores = [Store(os.path.join(directory.name, "data.jsonl"), os.path.join(directory.name, "users.json"), None, fsync=False),
+    ...           SqliteStore(os.path.join(directory.name, "data.db"), fsync=False)]
+    >>> def results(store):
+    ...     store.addUser("a", "Anna")
+    ...     store.addMessage({"type": "message", "from": "a", "to": "?", "content": {"text": "Hallo"}})
+    ...     store.addMessage({"type": "message", "from": "a", "to": "b", "content": b"\\x01\\x02", "encoding": "base64"})
+    ...     store.addMessage({"type": "message", "from": "b", "to": "c", "content": "Hallo c"})
+    ...     yield store.getMessages("b"), store.getMessagesSince(1, "c"), store.getMessagesSince(99), store.getUsersSince(1)
+    ...     store.clearMessages()
+    ...     store.addMessage({"type": "message", "from": "a", "to": "?", "content": "Neu"})
+    ...     yield store.getMessages(), store.getMessagesSince(3), store.getMessagesSince(4), store.getUsers(), store.getUserName("a")
+    >>> first, second = [list(results(store)) for store in stores]
+    >>> first == second
+    True
+    >>> second[1][1]  # doctest: +ELLIPSIS
+    {'messages': [{'type': 'message', 'from': 'a', 'to': '?', 'content': 'Neu', 'id': 5, 'time': ...}], 'lastId': 5, 'reset': True}
+    >>> for store in stores:
+    ...     store.close()
+    >>> directory.cleanup()
+    """
+
+    schema = """
+        PRAGMA auto_vacuum = INCREMENTAL;
+        PRAGMA journal_mode = WAL;
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            "from" TEXT NOT NULL,
+            "to" TEXT NOT NULL,
+            content, -- JSON, verschlüsselte Nachrichten ("encoding": "base64") als bytes
+            encoding TEXT,
+            time INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS messagesTo ON messages ("to", id);
+        CREATE INDEX IF NOT EXISTS messagesFrom ON messages ("from", id);
+        CREATE INDEX IF NOT EXISTS messagesTime ON messages (time); -- für das Entfernen alter Nachrichten
+        CREATE INDEX IF NOT EXISTS messagesTypeTime ON messages (type, time);
+        CREATE TABLE IF NOT EXISTS users (
+            version INTEGER PRIMARY KEY AUTOINCREMENT, -- Reihenfolge der Registrierung
+            uuid TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO users (uuid, name) VALUES ('?', 'Alle');
+    """
+
+    columns = 'id, type, "from", "to", content, encoding, time'
+
+    def __init__(self, filename="data.db", maxAge=None, maxMessagesPerConversation=None, keyExchangeTtl=None, compactInterval=60.0, fsync=True):
+        super().__init__(maxAge, maxMessagesPerConversation, keyExchangeTtl, compactInterval)
+        self.filename = filename
+        self.fsync = fsync
+        self.local = threading.local() # Verbindung pro Thread
+        self.connections = weakref.WeakSet() # nur für close(), die Verbindung eines beendeten Threads wird sofort geschlossen
+        self.connectionsLock = threading.Lock()
+        self.writeLock = threading.Lock() # SQLite erlaubt ohnehin nur einen schreibenden Thread
+        # Gespräche mit neuen Nachrichten seit dem letzten Entfernen alter Nachrichten, None: alle Gespräche (nach dem Start)
+        self.crowdedConversations = None
+
+        db = self.connect()
+        db.executescript(self.schema)
+        counters = dict(db.execute("SELECT name, value FROM counters"))
+        maxId = db.execute("SELECT max(id) FROM messages").fetchone()[0] or 0
+        self.clearedId = counters.get("clearedId", 0)
+        self.lastId = max(counters.get("lastId", 0), maxId, self.clearedId)
+
+        self.stopEvent = threading.Event()
+        self.compactThread = threading.Thread(target=self.run, name="store-compact", daemon=True)
+        self.compactThread.start()
+        atexit.register(self.close)
+
+    def connect(self):
+        """
+        Gibt die Verbindung des aktuellen Threads zurück und öffnet sie beim ersten Aufruf.\n
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # check_same_thread=False, damit close() alle Verbindungen schliessen kann
+            db = sqlite3.connect(self.filename, timeout=10, check_same_thread=False)
+            db.execute(f"PRAGMA synchronous = {'FULL' if self.fsync else 'NORMAL'}")
+            connection = self.local.connection = ThreadConnection(db)
+            with self.connectionsLock:
+                self.connections.add(connection)
+        return connection.db
+
+    @staticmethod
+    def toEntry(row):
+        id, type, fromUser, toUser, content, encoding, timestamp = row
+        entry = {
+            "type": type,
+            "from": fromUser,
+            "to": toUser,
+            "content": content if encoding == "base64" else json.loads(content)
+        }
+        if encoding is not None:
+            entry["encoding"] = encoding
+        entry["id"] = id
+        if timestamp is not None:
+            entry["time"] = timestamp
+        return entry
+
+    @staticmethod
+    def toRow(entry):
+        encoding = entry.get("encoding")
+        content = entry["content"]
+        if encoding != "base64":
+            content = json.dumps(content, separators=(",", ":"))
+        return (entry["id"], entry["type"], entry["from"], entry["to"], content, encoding, entry.get("time"))
+
+    def selectMessages(self, since, lastId, user):
+        """
+        Wählt die Nachrichten mit ids von `since` (exklusive) bis `lastId` aus. Mit `user` nur die Nachrichten von und an diesen Benutzer sowie die Nachrichten an alle.\n
+        """
+        db = self.connect()
+        if user is None:
+            rows = db.execute(f"SELECT {self.columns} FROM messages WHERE id > ? AND id <= ? ORDER BY id", (since, lastId))
+        else:
+            # jede Teilabfrage verwendet einen Index, UNION entfernt doppelte Nachrichten (z.B. eigene Nachrichten an alle)
+            rows = db.execute(f"""
+                SELECT {self.columns} FROM messages WHERE "to" = :user AND id > :since AND id <= :lastId
+                UNION SELECT {self.columns} FROM messages WHERE "from" = :user AND id > :since AND id <= :lastId
+                UNION SELECT {self.columns} FROM messages WHERE "to" = '?' AND id > :since AND id <= :lastId
+                ORDER BY id
+            """, {"user": user, "since": since, "lastId": lastId})
+        return [self.toEntry(row) for row in rows]
+
+    def getMessages(self, user=None):
+        return self.selectMessages(0, self.lastId, user)
+
+    def getMessagesSince(self, since, user=None):
+        lastId, clearedId = self.lastId, self.clearedId
+        # der Client kennt noch Nachrichten von vor dem Löschen oder hat eine unbekannte id
+        reset = since < clearedId or since > lastId
+        if reset:
+            since = 0
+        return {
+            "messages": self.selectMessages(since, lastId, user),
+            "lastId": lastId,
+            "reset": reset
+        }
+
+    def addMessage(self, entry):
+        db = self.connect()
+        with self.writeLock:
+            entry["id"] = self.lastId + 1
+            entry["time"] = int(time.time()) # für das Entfernen alter Nachrichten (compact)
+            with db:
+                db.execute(f"INSERT INTO messages ({self.columns}) VALUES (?, ?, ?, ?, ?, ?, ?)", self.toRow(entry))
+            self.lastId = entry["id"]
+            conversation = self.conversation(entry)
+            if conversation is not None and self.crowdedConversations is not None:
+                self.crowdedConversations.add(conversation)
+            self.messagesVersion += 1
+            return self.lastId
+
+    def clearMessages(self):
+        db = self.connect()
+        with self.writeLock:
+            clearedId = self.lastId + 1
+            with db:
+                db.execute("DELETE FROM messages")
+                db.executemany("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)",
+                               [("clearedId", clearedId), ("lastId", clearedId)])
+            self.lastId = self.clearedId = clearedId
+            self.messagesVersion += 1
+            return clearedId
+
+    def getUsers(self):
+        return dict(self.connect().execute("SELECT uuid, name FROM users ORDER BY version"))
+
+    def getUsersSince(self, since):
+        db = self.connect()
+        version = db.execute("SELECT max(version) FROM users").fetchone()[0] or 0
+        reset = since < 0 or since > version
+        if reset:
+            since = 0
+        rows = db.execute("SELECT uuid, name FROM users WHERE version > ? AND version <= ? ORDER BY version", (since, version))
+        return {
+            "users": dict(rows),
+            "version": version,
+            "reset": reset
+        }
+
+    def getUserName(self, uuid):
+        row = self.connect().execute("SELECT name FROM users WHERE uuid = ?", (uuid,)).fetchone()
+        return row[0] if row else None
+
+    def addUser(self, uuid, name):
+        db = self.connect()
+        with self.writeLock:
+            with db:
+                db.execute("INSERT INTO users (uuid, name) VALUES (?, ?) ON CONFLICT (uuid) DO UPDATE SET name = excluded.name", (uuid, name))
+            self.usersVersion += 1
+
+    def importData(self, messages, lastId, clearedId, users):
+        """
+        Übernimmt Nachrichten und Benutzer, z.B. von `readJsonFiles`. Bereits vorhandene Nachrichten (gleiche id) und Benutzer werden nicht überschrieben.\n
+
+        >>> import tempfile
+        >>> directory = tempfile.TemporaryDirectory()
+        >>> filename, filenameUsers = os.path.join(directory.name, "data.jsonl"), os.path.join(directory.name, "users.json")
+        >>> store = Store(filename, filenameUsers, None, fsync=False)
+        >>> store.addUser("a", "Anna")
+        >>> store.addMessage({"type": "message", "from": "a", "to": "?", "content": "Hallo"})
+        1
+        >>> store.clearMessages()
+        2
+        >>> store.addMessage({"type": "message", "from": "a", "to": "b", "content": b"\\x01", "encoding": "base64"})
+        3
+        >>> store.close()
+
+        >>> sqliteStore = SqliteStore(os.path.join(directory.name, "data.db"), fsync=False)
+        >>> sqliteStore.addUser("a", "Andrea")
+        >>> sqliteStore.importData(*readJsonFiles(filename, filenameUsers, None))
+        >>> sqliteStore.getMessages()  # doctest: +ELLIPSIS
+        [{'type': 'message', 'from': 'a', 'to': 'b', 'content': b'\\x01', 'encoding': 'base64', 'id': 3, 'time': ...}]
+        >>> sqliteStore.lastId, sqliteStore.clearedId, sqliteStore.getUsers()
+        (3, 2, {'?': 'Alle', 'a': 'Andrea'})
+        >>> sqliteStore.getMessagesSince(1)["reset"], sqliteStore.addMessage({"type": "message", "from": "a", "to": "?", "content": "Neu"})
+        (True, 4)
+        >>> sqliteStore.close()
+        >>> directory.cleanup()
+        """
+        db = self.connect()
+        with self.writeLock:
+            with db:
+                db.executemany(f"INSERT OR IGNORE INTO messages ({self.columns}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               [self.toRow(entry) for entry in messages])
+                db.executemany("INSERT OR IGNORE INTO users (uuid, name) VALUES (?, ?)", users.items())
+                self.clearedId = max(self.clearedId, clearedId)
+                self.lastId = max(self.lastId, lastId)
+                db.executemany("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)",
+                               [("clearedId", self.clearedId), ("lastId", self.lastId)])
+            self.crowdedConversations = None
+            self.messagesVersion += 1
+            self.usersVersion += 1
+
+    def compact(self, now=None):
+        """
+        Entfernt die alten Nachrichten (siehe `BaseStore`) und gibt die Anzahl entfernter Nachrichten sowie der freigegebenen Bytes zurück.\n
+        Die abgelaufenen Nachrichten werden über die Indexe auf time und (type, time) gefunden, statt alle Nachrichten durchzugehen.\n
+
+        >>> import tempfile
+        >>> directory = tempfile.TemporaryDirectory()
+        >>> store = SqliteStore(os.path.join(directory.name, "data.db"), maxAge=3600, maxMessagesPerConversation=2, keyExchangeTtl=60, fsync=False)
+        >>> for i in range(3):
+        ...     _ = store.addMessage({"type": "message", "from": "a", "to": "b", "content": i})
+        >>> _ = store.addMessage({"type": "message", "from": "b", "to": "a", "content": "Antwort"})
+        >>> _ = store.addMessage({"type": "keyExchange", "from": "a", "to": "b", "content": "Schlüssel"})
+        >>> now = time.time()
+        >>> store.compact(now)[0], [entry["id"] for entry in store.getMessages()]
+        (2, [3, 4, 5])
+        >>> store.compact(now + 120)[0], [entry["id"] for entry in store.getMessages()]
+        (1, [3, 4])
+        >>> store.compact(now + 7200)[0], store.getMessages()
+        (2, [])
+        >>> store.close()
+        >>> directory.cleanup()
+        """
+        if now is None:
+            now = time.time()
+        db = self.connect()
+        with self.writeLock:
+            pageSize = db.execute("PRAGMA page_size").fetchone()[0]
+            pagesBefore = db.execute("PRAGMA page_count").fetchone()[0]
+            removed = 0
+            with db:
+                # die Indexe auf time und (type, time) liefern nur die abgelaufenen Nachrichten
+                if self.maxAge is not None:
+                    removed += db.execute("DELETE FROM messages WHERE time < ?", (now - self.maxAge,)).rowcount
+                if self.keyExchangeTtl is not None:
+                    removed += db.execute("DELETE FROM messages WHERE type IN (?, ?) AND time < ?",
+                                          (*self.keyExchangeTypes, now - self.keyExchangeTtl)).rowcount
+                if self.maxMessagesPerConversation is not None:
+                    removed += self.removeCrowded(db)
+                if removed:
+                    # damit ids nicht wiederverwendet werden, falls die neuste Nachricht entfernt wurde
+                    db.execute("INSERT OR REPLACE INTO counters (name, value) VALUES ('lastId', ?)", (self.lastId,))
+            self.crowdedConversations = set()
+            if not removed:
+                return 0, 0
+            # freie Seiten an das Dateisystem zurückgeben
+            db.execute("PRAGMA incremental_vacuum")
+            pagesAfter = db.execute("PRAGMA page_count").fetchone()[0]
+            self.messagesVersion += 1
+        return removed, (pagesBefore - pagesAfter) * pageSize
+
+    def removeCrowded(self, db):
+        """
+        Entfernt die ältesten Nachrichten der Gespräche mit mehr als `maxMessagesPerConversation` Nachrichten und gibt ihre Anzahl zurück.\n
+        Nur die Gespräche mit neuen Nachrichten seit dem letzten Mal werden gezählt, nach dem Start einmal alle. Muss mit gesperrtem `writeLock` aufgerufen werden.\n
+        """
+        conversations = self.crowdedConversations
+        if conversations is None:
+            conversations = {self.conversation({"type": "message", "from": fromUser, "to": toUser})
+                             for fromUser, toUser in db.execute("""SELECT DISTINCT "from", "to" FROM messages WHERE type = 'message'""")}
+        removed = 0
+        for conversation in conversations:
+            if conversation == "?":
+                where, parameters = '"to" = :a', {"a": "?"}
+            else:
+                # ein Gespräch mit sich selbst hat nur einen Benutzer
+                users = sorted(conversation)
+                where = '("from" = :a AND "to" = :b OR "from" = :b AND "to" = :a)'
+                parameters = {"a": users[0], "b": users[-1]}
+            # die Teilabfrage verwendet die Indexe auf ("to", id) und ("from", id), "+type" verhindert den Index auf (type, time)
+            removed += db.execute(f"""
+                DELETE FROM messages WHERE id IN (
+                    SELECT id FROM messages WHERE +type = 'message' AND {where} ORDER BY id DESC LIMIT -1 OFFSET :keep
+                )
+            """, {**parameters, "keep": self.maxMessagesPerConversation}).rowcount
+        return removed
+
+    def waitUntilSaved(self, timeout=None):
+        # jede Änderung ist bereits beim Schreiben gespeichert
+        return True
+
+    def run(self):
+        while not self.stopEvent.wait(self.compactInterval):
+            try:
+                removed, reclaimed = self.compact()
+                if removed or reclaimed:
+                    print(f"Store: {removed} alte Nachrichten entfernt, {reclaimed} Bytes freigegeben", file=sys.stderr)
+            except Exception:
+                traceback.print_exc()
+
+    def close(self):
+        """
+        Beendet den Hintergrund-Thread und schliesst alle Verbindungen.\n
+        """
+        if self.stopEvent.is_set():
+            return
+        self.stopEvent.set()
+        self.compactThread.join()
+        with self.connectionsLock:
+            for connection in list(self.connections):
+                connection.db.close()
+            self.connections.clear()
+        atexit.unregister(self.close)